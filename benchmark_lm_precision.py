@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+import h5py
+import tensorflow as tf
+
+import util
+import coref_model as cm
+
+
+def convert_features(input_filename, output_filename, precision):
+  """Writes a copy of a float32 features file with the given storage precision."""
+  with h5py.File(input_filename, "r") as input_file, h5py.File(output_filename, "w") as output_file:
+    for file_key, group in input_file.items():
+      if "embeddings" not in group:
+        raise ValueError("{} uses the per-sentence layout, extract the features again".format(input_filename))
+      embeddings = util.dequantize_lm_emb(group["embeddings"][...], group["scales"][...] if "scales" in group else None)
+      embeddings, scales = util.quantize_lm_emb(embeddings, precision)
+      output_file.create_dataset("{}/embeddings".format(file_key), data=embeddings)
+      output_file.create_dataset("{}/sentence_offsets".format(file_key), data=group["sentence_offsets"][...])
+      if scales is not None:
+        output_file.create_dataset("{}/scales".format(file_key), data=scales)
+
+
+def evaluate(config, lm_path):
+  tf.reset_default_graph()
+  config["lm_path"] = lm_path
+  model = cm.CorefModel(config, eval_mode=True)
+  try:
+    start_time = time.time()
+    for file_key in model.lm_file:
+      model.load_lm_embeddings(file_key)
+    load_time = time.time() - start_time
+
+    with tf.Session() as session:
+      model.restore(session)
+      _, f1, mention_f1 = model.evaluate(session, official_stdout=True, test=True)
+  finally:
+    # The file of the next precision may be the same path, written again.
+    model.lm_file.close()
+  return load_time, f1, mention_f1
+
+
+if __name__ == "__main__":
+  if len(sys.argv) < 3:
+    sys.exit("Usage: {} <experiment> <eval_file> [<precision>,...]\n"
+             "Prints the size, load time, F1 and mention F1 of each precision. The F1 is CorefModel.evaluate's "
+             "\"py\" F1: the average of the MUC, B3 and CEAFe F1s, computed in Python, not by the official CoNLL "
+             "scorer.".format(sys.argv[0]))
+
+  experiment = sys.argv[1]
+  eval_path = sys.argv[2]
+  precisions = sys.argv[3].split(",") if len(sys.argv) > 3 else util.LM_PRECISIONS
+
+  config = util.initialize_from_env(experiment)
+  config["eval_path"] = eval_path
+  reference_path = config["lm_path"]
+
+  results = []
+  for precision in precisions:
+    lm_path = reference_path
+    if precision != "float32":
+      lm_path = "{}.{}.hdf5".format(os.path.splitext(reference_path)[0], precision)
+      print("Writing {}...".format(lm_path))
+      convert_features(reference_path, lm_path, precision)
+    load_time, f1, mention_f1 = evaluate(config, lm_path)
+    results.append((precision, os.path.getsize(lm_path), load_time, f1, mention_f1))
+
+  print("=" * 72)
+  print("{:<10} {:>12} {:>12} {:>12} {:>12}".format("precision", "size (MB)", "load (s)", "F1 (py)", "mention F1"))
+  for precision, size, load_time, f1, mention_f1 in results:
+    print("{:<10} {:>12.1f} {:>12.2f} {:>12.2f} {:>12.2f}".format(precision, size / 2 ** 20, load_time, f1, mention_f1))
@@ -0,0 +1,73 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import io
+import sys
+
+import numpy as np
+
+import util
+
+
+def parse_line(line):
+  word_end = line.find(" ")
+  return line[:word_end], np.fromstring(line[word_end + 1:], np.float32, sep=" ")
+
+
+def count_embeddings(filename):
+  num_words = 0
+  size = None
+  with open(filename) as f:
+    for i, line in enumerate(f):
+      if size is None:
+        _, embedding = parse_line(line)
+        if i == 0 and len(embedding) == 1:
+          continue
+        size = len(embedding)
+      num_words += 1
+  return num_words, size
+
+
+def convert_embeddings(filename, normalize=True):
+  """
+  Converts a text embedding file (fastText `.vec` format) into:
+  - a `.vocab` file: a "<num_words> <size> <normalized>" header, then one word
+    per line,
+  - a `.npy` float32 [num_words + 1, size] matrix, row 0 being the (zero)
+    embedding of unknown words, row i + 1 the embedding of the i-th word.
+  Rows are L2-normalized, as expected by `util.EmbeddingDictionary`, unless
+  `normalize` is False.
+  """
+  vocab_filename, matrix_filename = util.get_binary_embedding_paths(filename)
+  num_words, size = count_embeddings(filename)
+  matrix = np.lib.format.open_memmap(matrix_filename, mode="w+", dtype=np.float32, shape=(num_words + 1, size))
+  matrix[0] = 0
+  row = 1
+  with open(filename) as in_file:
+    with io.open(vocab_filename, "w", encoding="utf-8", newline="\n") as vocab_file:
+      vocab_file.write(u"{} {} {}\n".format(num_words, size, int(normalize)))
+      for i, line in enumerate(in_file):
+        word, embedding = parse_line(line)
+        if i == 0 and len(embedding) == 1:
+          continue
+        assert len(embedding) == size, "%d,%d: %d: %s" % (len(embedding), size, i, line)
+        vocab_file.write(word + u"\n")
+        if normalize:
+          norm = np.linalg.norm(embedding)
+          if norm > 0:
+            embedding /= norm
+        matrix[row] = embedding
+        row += 1
+  matrix.flush()
+  del matrix
+  return vocab_filename, matrix_filename, num_words
+
+
+if __name__ == "__main__":
+  args = [a for a in sys.argv[1:] if a != "--raw"]
+  if len(args) != 1:
+    sys.exit("Usage: {} <embeddings> [--raw]".format(sys.argv[0]))
+
+  vocab_filename, matrix_filename, num_words = convert_embeddings(args[0], normalize="--raw" not in sys.argv)
+  print("Wrote {} words to {} and {}.".format(num_words, vocab_filename, matrix_filename))
@@ -5,22 +5,23 @@ from __future__ import print_function
 import os
 import operator
 import random
+import itertools
 import math
 import json
-import threading
+import hashlib
 import numpy as np
 import tensorflow as tf
 import tensorflow_hub as hub
 import h5py
 
 import util
-#import coref_ops # depends on config['use_gold_mentions']
+import coref_ops
 import conll
 import metrics
 from util import attention_layer
 
 class CorefModel(object):
-    def __init__(self, config, eval_mode=False):
+    def __init__(self, config, eval_mode=False, lm_extractor=None, use_tensorize_cache=False):
         self.config = config
 
 
@@ -29,49 +30,66 @@ class CorefModel(object):
 
         ###
 
-        #### import coref_ops depending on 'gold_mentions' config
-        global coref_ops
+        if 0 < config["candidate_ratio"] <= config["top_span_ratio"]:
+            raise ValueError("candidate_ratio ({}) must be above top_span_ratio ({})".format(
+                config["candidate_ratio"], config["top_span_ratio"]))
+
         if config['use_gold_mentions']:
            print('   /!\\ using gold mentions /!\\   ')
-           import coref_ops_gold_mentions as coref_ops
         else:
            print('   /!\\ **not** using gold mentions /!\\   ')
-           import coref_ops
-        ####
 
         self.context_embeddings = util.EmbeddingDictionary(config["context_embeddings"])
         self.head_embeddings = util.EmbeddingDictionary(config["head_embeddings"], maybe_cache=self.context_embeddings)
+        # When both use the same table, a single array is built and fed for both.
+        self.shared_word_embeddings = self.head_embeddings.shares_table_with(self.context_embeddings)
         self.char_embedding_size = config["char_embedding_size"]
         self.char_dict = util.load_char_dict(config["char_vocab_path"])
         self.max_span_width = config["max_span_width"]
         self.genres = {g: i for i, g in enumerate(config["genres"])}
-        if config["lm_path"]:
+        # Computes the LM features in memory (see extract_features.BertFeatureExtractor) instead of reading lm_path.
+        self.lm_extractor = lm_extractor
+        if config["lm_path"] and lm_extractor is None:
             self.lm_file = h5py.File(self.config["lm_path"], "r")
         else:
             self.lm_file = None
-        self.lm_layers = self.config["lm_layers"]
+        # Pre-mixed features (export_lm_mix.py) have a single, already weighted, layer.
+        self.lm_layers = 1 if self.config["lm_premixed"] else self.config["lm_layers"]
+        if lm_extractor is not None and lm_extractor.num_layers != self.lm_layers:
+            raise ValueError("The LM extractor computes {} layers, expected {} (check lm_premixed)".format(
+                lm_extractor.num_layers, self.lm_layers))
         self.lm_size = self.config["lm_size"]
         self.eval_data = None  # Load eval data lazily.
+        # Only for the train and eval files (train.py, evaluate.py): not for arbitrary documents to predict.
+        if use_tensorize_cache and (config["tensorize_cache_size_mb"] > 0 or config["tensorize_cache_dir"]):
+            cache_dir = config["tensorize_cache_dir"]
+            if cache_dir:
+                cache_dir = os.path.join(cache_dir, self.get_tensorize_config_hash())
+            self.tensorize_cache = util.TensorizationCache(config["tensorize_cache_size_mb"] * 2 ** 20, cache_dir)
+        else:
+            self.tensorize_cache = None
 
         input_props = []
         input_props.append((tf.string, [None, None]))  # Tokens.
         input_props.append((tf.float32, [None, None, self.context_embeddings.size]))  # Context embeddings.
-        input_props.append((tf.float32, [None, None, self.head_embeddings.size]))  # Head embeddings.
+        if not self.shared_word_embeddings:
+            input_props.append((tf.float32, [None, None, self.head_embeddings.size]))  # Head embeddings.
         input_props.append((tf.float32, [None, None, self.lm_size, self.lm_layers]))  # LM embeddings.
         input_props.append((tf.int32, [None, None, None]))  # Character indices.
         input_props.append((tf.int32, [None]))  # Text lengths.
         input_props.append((tf.int32, [None]))  # Speaker IDs.
-        input_props.append((tf.int32, []))  # Genre.
+        input_props.append((tf.int32, [None]))  # Genres, one per document.
         input_props.append((tf.bool, []))  # Is training.
         input_props.append((tf.int32, [None]))  # Gold starts.
         input_props.append((tf.int32, [None]))  # Gold ends.
         input_props.append((tf.int32, [None]))  # Cluster ids.
+        input_props.append((tf.int32, [None]))  # Document ids (of each word).
 
-        self.queue_input_tensors = [tf.placeholder(dtype, shape) for dtype, shape in input_props]
-        dtypes, shapes = zip(*input_props)
-        queue = tf.PaddingFIFOQueue(capacity=10, dtypes=dtypes, shapes=shapes)
-        self.enqueue_op = queue.enqueue(self.queue_input_tensors)
-        self.input_tensors = queue.dequeue()
+        # Training reads the documents from this iterator; prediction and evaluation feed the input tensors.
+        self.train_index = None  # Loaded lazily, by the iterator.
+        self.train_start_step = 0
+        self.train_iterator = self.get_train_dataset(input_props).make_initializable_iterator()
+        self.input_tensors = self.share_word_embeddings(self.train_iterator.get_next())
 
         self.predictions, self.loss = self.get_predictions_and_loss(*self.input_tensors)
         self.global_step = tf.Variable(0, name="global_step", trainable=False)
@@ -111,6 +129,20 @@ class CorefModel(object):
             self.switch_to_train_mode_op = tf.cond(self.is_training, lambda: tf.group(), self.to_training)
             self.switch_to_test_mode_op = tf.cond(self.is_training, self.to_testing, lambda: tf.group())
 
+    def share_word_embeddings(self, tensors):
+        # Puts the shared embeddings tensor back in the head embeddings position, as in tensorize_example().
+        tensors = list(tensors)
+        if self.shared_word_embeddings:
+            tensors.insert(2, tensors[1])
+        return tensors
+
+    def unshare_word_embeddings(self, tensors):
+        # Inverse of share_word_embeddings().
+        tensors = list(tensors)
+        if self.shared_word_embeddings:
+            del tensors[2]
+        return tensors
+
     def ema_to_weights(self):
         return tf.group(*(tf.assign(var, self.ema.average(var).read_value())
                           for var in self.trainable_variables))
@@ -130,26 +162,61 @@ class CorefModel(object):
         with tf.control_dependencies([self.save_weight_backups()]):
             return self.ema_to_weights()
 
-    def start_enqueue_thread(self, session):
-        with open(self.config["train_path"]) as f:
-            train_examples = [json.loads(jsonline) for jsonline in f.readlines()]
-
-        def _enqueue_loop():
-            while True:
-                #with open(self.config["train_path"]) as f:
-                #    train_examples = [json.loads(jsonline) for jsonline in f.readlines()]
-                random.shuffle(train_examples)
-                for example in train_examples:
-                    tensorized_example = self.tensorize_example(example, is_training=True)
-                    #### if no mentions in document, skip (see explanations in tensorize_example())
-                    if tensorized_example is None:
-                        continue
-                    feed_dict = dict(zip(self.queue_input_tensors, tensorized_example))
-                    session.run(self.enqueue_op, feed_dict=feed_dict)
-
-        enqueue_thread = threading.Thread(target=_enqueue_loop)
-        enqueue_thread.daemon = True
-        enqueue_thread.start()
+    def load_train_index(self):
+        if self.train_index is None:
+            train_index = util.JsonlinesIndex(self.config["train_path"])
+            if len(train_index) == 0:
+                raise ValueError("No training documents in {}".format(self.config["train_path"]))
+            self.train_index = train_index
+        return self.train_index
+
+    def get_train_dataset(self, input_props):
+        # Training documents, reshuffled each epoch from shuffle_seed and tensorized in parallel.
+        dtypes, shapes = zip(*input_props)
+
+        def shuffled_indices():
+            train_index = self.load_train_index()
+            # Long documents are truncated to max_training_sentences.
+            size_keys = np.stack([np.minimum(train_index.num_sentences, self.config["max_training_sentences"]),
+                                  train_index.max_sentence_lengths], axis=1)
+            # A resumed run continues the order from the restored global step (one step per document; documents
+            # without mentions are skipped without a step, so the position in the epoch is approximate).
+            start_epoch, start_offset = divmod(self.train_start_step, len(train_index))
+            for epoch in itertools.count(start_epoch):
+                random_state = np.random.RandomState(self.config["shuffle_seed"] + epoch)
+                indices = random_state.permutation(len(train_index))
+                if self.config["train_bucket_window"] > 0:
+                    indices = util.bucket_indices(indices, size_keys, self.config["train_bucket_window"],
+                                                  self.config["train_bucket_size"], random_state)
+                if epoch == start_epoch:
+                    indices = indices[start_offset:]
+                for i in indices:
+                    yield i
+
+        def tensorize(i):
+            tensorized_example = self.tensorize_example(self.train_index.read(i), is_training=True)
+            #### if no mentions in document, skip (see explanations in tensorize_example())
+            if tensorized_example is None:
+                return [False] + [np.zeros([0] * len(shape), dtype=dtype.as_numpy_dtype) for dtype, shape in input_props]
+            return [True] + self.unshare_word_embeddings(tensorized_example)
+
+        def set_shapes(is_valid, *tensors):
+            for tensor, shape in zip(tensors, shapes):
+                tensor.set_shape(shape)
+            return tensors
+
+        dataset = tf.data.Dataset.from_generator(shuffled_indices, tf.int64, tf.TensorShape([]))
+        dataset = dataset.map(lambda i: tuple(tf.py_func(tensorize, [i], (tf.bool,) + dtypes)),
+                              num_parallel_calls=self.config["train_tensorize_threads"])
+        dataset = dataset.filter(lambda is_valid, *tensors: tf.reshape(is_valid, []))
+        dataset = dataset.map(set_shapes)
+        return dataset.prefetch(self.config["train_prefetch_documents"])
+
+    def start_input_pipeline(self, session):
+        # After restoring the checkpoint, if any: the shuffling order starts at its global step.
+        self.train_start_step = session.run(self.global_step)
+        self.load_train_index()  # Fails here, not in the input pipeline, if there are no training documents.
+        session.run(self.train_iterator.initializer)
 
     def restore(self, session, latest_checkpoint=False, fpath=None):
 
@@ -169,12 +236,22 @@ class CorefModel(object):
 
     def load_lm_embeddings(self, doc_key):
         if self.lm_file is None:
-            return np.zeros([0, 0, self.lm_size, self.lm_layers])
+            return np.zeros([0, 0, self.lm_size, self.lm_layers], dtype=np.float32)
         file_key = doc_key.replace("/", ":")
         group = self.lm_file[file_key]
+        if "embeddings" in group:
+            # Document layout: a single read of all the tokens, then split by sentence.
+            scales = group["scales"][...] if "scales" in group else None
+            embeddings = util.dequantize_lm_emb(group["embeddings"][...], scales)
+            if embeddings.shape[2] != self.lm_layers:
+                raise ValueError("{} has {} LM layers, expected {} (check lm_premixed)".format(
+                    self.config["lm_path"], embeddings.shape[2], self.lm_layers))
+            return util.pad_by_sentence(embeddings, group["sentence_offsets"][...])
+        # Sentence layout (files extracted by older versions): one dataset per sentence.
         num_sentences = len(list(group.keys()))
         sentences = [group[str(i)][...] for i in range(num_sentences)]
-        lm_emb = np.zeros([num_sentences, max(s.shape[0] for s in sentences), self.lm_size, self.lm_layers])
+        lm_emb = np.zeros([num_sentences, max(s.shape[0] for s in sentences), self.lm_size, self.lm_layers],
+                          dtype=np.float32)
         for i, s in enumerate(sentences):
             lm_emb[i, :s.shape[0], :, :] = s
         return lm_emb
@@ -185,17 +262,55 @@ class CorefModel(object):
             starts, ends = zip(*mentions)
         else:
             starts, ends = [], []
-        return np.array(starts), np.array(ends)
+        return np.array(starts, dtype=np.int32), np.array(ends, dtype=np.int32)
 
     def tensorize_span_labels(self, tuples, label_dict):
         if len(tuples) > 0:
             starts, ends, labels = zip(*tuples)
         else:
             starts, ends, labels = [], [], []
-        return np.array(starts), np.array(ends), np.array([label_dict[c] for c in labels])
-
-
+        return (np.array(starts, dtype=np.int32), np.array(ends, dtype=np.int32),
+                np.array([label_dict[c] for c in labels], dtype=np.int32))
+
+    def get_tensorize_config_hash(self):
+        # What the tensors of a document depend on, besides the document itself.
+        keys = ["context_embeddings", "head_embeddings", "char_vocab_path", "genres", "filter_widths", "lm_size",
+                "lm_layers", "lm_premixed", "use_gold_mentions", "include_singletons", "max_span_width"]
+        values = [self.config[key] for key in keys]
+        # Files regenerated in place (e.g. by setup_training.sh) must not reuse their old tensors.
+        paths = [self.config["char_vocab_path"]]
+        for key in ["context_embeddings", "head_embeddings"]:
+            path = self.config[key]["path"]
+            paths += [path] + list(util.get_binary_embedding_paths(path))
+        if self.lm_extractor is not None:
+            values.append("lm_extractor")
+        elif self.lm_file is not None:
+            paths.append(self.config["lm_path"])
+        for path in paths:
+            if os.path.exists(path):
+                stat = os.stat(path)
+                values.append([path, stat.st_mtime, stat.st_size])
+        return hashlib.sha1(json.dumps(values, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+    def get_tensorize_cache_key(self, example):
+        # The doc_key, and a hash of the content: documents may share a doc_key, or be edited.
+        content = json.dumps([example["sentences"], example["speakers"], example["clusters"]])
+        return "{}:{}".format(example["doc_key"], hashlib.sha1(content.encode("utf-8")).hexdigest())
+
+    def get_cached_tensors(self, cache_key, is_training):
+        if self.tensorize_cache is None:
+            return None
+        tensors = self.tensorize_cache.get(cache_key)
+        if tensors is None:
+            return None
+        tensors = self.share_word_embeddings(tensors)
+        tensors.insert(8, is_training)
+        return tuple(tensors)
 
+    def put_cached_tensors(self, cache_key, example_tensors):
+        tensors = list(example_tensors)
+        del tensors[8]  # Is training.
+        self.tensorize_cache.put(cache_key, self.unshare_word_embeddings(tensors))
 
     def tensorize_example(self, example, is_training):
 
@@ -227,7 +342,7 @@ class CorefModel(object):
 
         gold_mentions = sorted(tuple(m) for m in util.flatten(clusters))
         gold_mention_map = {m: i for i, m in enumerate(gold_mentions)}
-        cluster_ids = np.zeros(len(gold_mentions))
+        cluster_ids = np.zeros(len(gold_mentions), dtype=np.int32)
         for cluster_id, cluster in enumerate(clusters):
             for mention in cluster:
                 cluster_ids[gold_mention_map[tuple(mention)]] = cluster_id + 1
@@ -240,38 +355,47 @@ class CorefModel(object):
             return None
 
 
-        speakers = util.flatten(example["speakers"])
+        # Only the truncation of training documents is random: the rest is computed once if cached.
+        cache_key = self.get_tensorize_cache_key(example) if self.tensorize_cache is not None else None
+        example_tensors = self.get_cached_tensors(cache_key, is_training)
+        if example_tensors is None:
+            speakers = util.flatten(example["speakers"])
 
-        assert num_words == len(speakers)
+            assert num_words == len(speakers)
 
-        max_sentence_length = max(len(s) for s in sentences)
-        max_word_length = max(max(max(len(w) for w in s) for s in sentences), max(self.config["filter_widths"]))
-        text_len = np.array([len(s) for s in sentences])
-        tokens = [[""] * max_sentence_length for _ in sentences]
-        context_word_emb = np.zeros([len(sentences), max_sentence_length, self.context_embeddings.size])
-        head_word_emb = np.zeros([len(sentences), max_sentence_length, self.head_embeddings.size])
-        char_index = np.zeros([len(sentences), max_sentence_length, max_word_length])
-        for i, sentence in enumerate(sentences):
-            for j, word in enumerate(sentence):
-                tokens[i][j] = word
-                context_word_emb[i, j] = self.context_embeddings[word]
-                head_word_emb[i, j] = self.head_embeddings[word]
-                char_index[i, j, :len(word)] = [self.char_dict[c] for c in word]
-        tokens = np.array(tokens)
+            max_sentence_length = max(len(s) for s in sentences)
+            max_word_length = max(max(max(len(w) for w in s) for s in sentences), max(self.config["filter_widths"]))
+            text_len = np.array([len(s) for s in sentences], dtype=np.int32)
+            tokens = [[""] * max_sentence_length for _ in sentences]
+            context_word_emb = self.context_embeddings.lookup_sentences(sentences, max_sentence_length)
+            if self.shared_word_embeddings:
+                head_word_emb = context_word_emb
+            else:
+                head_word_emb = self.head_embeddings.lookup_sentences(sentences, max_sentence_length)
+            for i, sentence in enumerate(sentences):
+                tokens[i][:len(sentence)] = sentence
+            tokens = np.array(tokens)
+            char_index = self.char_dict.index_sentences(sentences, max_sentence_length, max_word_length)
 
-        speaker_dict = {s: i for i, s in enumerate(set(speakers))}
-        speaker_ids = np.array([speaker_dict[s] for s in speakers])
+            speaker_dict = {s: i for i, s in enumerate(set(speakers))}
+            speaker_ids = np.array([speaker_dict[s] for s in speakers], dtype=np.int32)
 
-        doc_key = example["doc_key"]
-        genre = self.genres[doc_key[:2]]
+            doc_key = example["doc_key"]
+            genre = np.array([self.genres[doc_key[:2]]], dtype=np.int32)
+            doc_ids = np.zeros(num_words, dtype=np.int32)
 
-        gold_starts, gold_ends = self.tensorize_mentions(gold_mentions)
+            gold_starts, gold_ends = self.tensorize_mentions(gold_mentions)
 
-        lm_emb = self.load_lm_embeddings(doc_key)
+            if self.lm_extractor is not None:
+                lm_emb = self.lm_extractor.extract(example)
+            else:
+                lm_emb = self.load_lm_embeddings(doc_key)
 
-        example_tensors = (
-            tokens, context_word_emb, head_word_emb, lm_emb, char_index, text_len, speaker_ids, genre, is_training,
-            gold_starts, gold_ends, cluster_ids)
+            example_tensors = (
+                tokens, context_word_emb, head_word_emb, lm_emb, char_index, text_len, speaker_ids, genre, is_training,
+                gold_starts, gold_ends, cluster_ids, doc_ids)
+            if self.tensorize_cache is not None:
+                self.put_cached_tensors(cache_key, example_tensors)
 
         if is_training and len(sentences) > self.config["max_training_sentences"]:
             res = self.truncate_example(*example_tensors)
@@ -283,7 +407,7 @@ class CorefModel(object):
 
 
     def truncate_example(self, tokens, context_word_emb, head_word_emb, lm_emb, char_index, text_len, speaker_ids,
-                         genre, is_training, gold_starts, gold_ends, cluster_ids):
+                         genre, is_training, gold_starts, gold_ends, cluster_ids, doc_ids):
         max_training_sentences = self.config["max_training_sentences"]
         num_sentences = context_word_emb.shape[0]
         assert num_sentences > max_training_sentences
@@ -292,8 +416,12 @@ class CorefModel(object):
         word_offset = text_len[:sentence_offset].sum()
         num_words = text_len[sentence_offset:sentence_offset + max_training_sentences].sum()
         tokens = tokens[sentence_offset:sentence_offset + max_training_sentences, :]
+        shared_word_emb = head_word_emb is context_word_emb
         context_word_emb = context_word_emb[sentence_offset:sentence_offset + max_training_sentences, :, :]
-        head_word_emb = head_word_emb[sentence_offset:sentence_offset + max_training_sentences, :, :]
+        if shared_word_emb:
+            head_word_emb = context_word_emb
+        else:
+            head_word_emb = head_word_emb[sentence_offset:sentence_offset + max_training_sentences, :, :]
         lm_emb = lm_emb[sentence_offset:sentence_offset + max_training_sentences, :, :, :]
         char_index = char_index[sentence_offset:sentence_offset + max_training_sentences, :, :]
         text_len = text_len[sentence_offset:sentence_offset + max_training_sentences]
@@ -303,11 +431,71 @@ class CorefModel(object):
         gold_starts = gold_starts[gold_spans] - word_offset
         gold_ends = gold_ends[gold_spans] - word_offset
         cluster_ids = cluster_ids[gold_spans]
+        doc_ids = doc_ids[word_offset: word_offset + num_words]
 
         if not len(gold_starts):
             return None
 
-        return tokens, context_word_emb, head_word_emb, lm_emb, char_index, text_len, speaker_ids, genre, is_training, gold_starts, gold_ends, cluster_ids
+        return tokens, context_word_emb, head_word_emb, lm_emb, char_index, text_len, speaker_ids, genre, is_training, gold_starts, gold_ends, cluster_ids, doc_ids
+
+    def tensorize_batch(self, tensorized_examples):
+        # Packs several tensorized documents into one input; also returns the word offsets of the documents.
+        columns = list(zip(*tensorized_examples))
+        (tokens, context_word_emb, head_word_emb, lm_emb, char_index, text_len, speaker_ids, genre, is_training,
+         gold_starts, gold_ends, cluster_ids, _) = columns
+        num_words = [len(s) for s in speaker_ids]
+        word_offsets = np.cumsum([0] + num_words)
+        max_sentence_length = max(t.shape[1] for t in tokens)
+        max_word_length = max(c.shape[2] for c in char_index)
+
+        def pad_and_concatenate(arrays, *sizes, constant_values=0):
+            # Pads the dimensions after the first one up to `sizes`, then concatenates along the first one.
+            padded = []
+            for a in arrays:
+                pad_width = [(0, 0)] + [(0, size - a.shape[i + 1]) for i, size in enumerate(sizes)]
+                pad_width += [(0, 0)] * (a.ndim - len(pad_width))
+                padded.append(np.pad(a, pad_width, mode="constant", constant_values=constant_values))
+            return np.concatenate(padded)
+
+        speaker_offsets = np.cumsum([0] + [s.max() + 1 if len(s) else 0 for s in speaker_ids])
+        cluster_offsets = np.cumsum([0] + [c.max() if len(c) else 0 for c in cluster_ids])
+
+        batch_context_word_emb = pad_and_concatenate(context_word_emb, max_sentence_length)
+        if self.shared_word_embeddings:
+            batch_head_word_emb = batch_context_word_emb
+        else:
+            batch_head_word_emb = pad_and_concatenate(head_word_emb, max_sentence_length)
+        if all(l.shape[0] == 0 for l in lm_emb):
+            batch_lm_emb = lm_emb[0]  # No LM features (ELMo is computed by the graph).
+        else:
+            batch_lm_emb = pad_and_concatenate(lm_emb, max_sentence_length)
+
+        tensors = (
+            pad_and_concatenate(tokens, max_sentence_length, constant_values=""),
+            batch_context_word_emb,
+            batch_head_word_emb,
+            batch_lm_emb,
+            pad_and_concatenate(char_index, max_sentence_length, max_word_length),
+            np.concatenate(text_len),
+            np.concatenate([s + o for s, o in zip(speaker_ids, speaker_offsets)]).astype(np.int32),
+            np.concatenate(genre),
+            any(is_training),
+            np.concatenate([s + o for s, o in zip(gold_starts, word_offsets)]).astype(np.int32),
+            np.concatenate([e + o for e, o in zip(gold_ends, word_offsets)]).astype(np.int32),
+            np.concatenate([np.where(c > 0, c + o, 0) for c, o in zip(cluster_ids, cluster_offsets)]).astype(np.int32),
+            np.repeat(np.arange(len(tensorized_examples), dtype=np.int32), num_words))
+        return tensors, word_offsets
+
+    def split_batch_predictions(self, top_span_starts, top_span_ends, top_antecedents, top_antecedent_scores,
+                                word_offsets):
+        # Splits the predictions of a tensorize_batch() input by document.
+        num_docs = len(word_offsets) - 1
+        span_doc_ids = np.searchsorted(word_offsets, top_span_starts, side="right") - 1
+        span_offsets = np.searchsorted(span_doc_ids, np.arange(num_docs + 1))
+        for d in range(num_docs):
+            spans = slice(span_offsets[d], span_offsets[d + 1])
+            yield (top_span_starts[spans] - word_offsets[d], top_span_ends[spans] - word_offsets[d],
+                   top_antecedents[spans] - span_offsets[d], top_antecedent_scores[spans])
 
     def get_candidate_labels(self, candidate_starts, candidate_ends, labeled_starts, labeled_ends, labels):
         same_start = tf.equal(tf.expand_dims(labeled_starts, 1),
@@ -323,11 +511,12 @@ class CorefModel(object):
     def get_dropout(self, dropout_rate, is_training):
         return 1 - (tf.to_float(is_training) * dropout_rate)
 
-    def coarse_to_fine_pruning(self, top_span_emb, top_span_mention_scores, c):
+    def coarse_to_fine_pruning(self, top_span_emb, top_span_mention_scores, top_span_doc_ids, c):
         k = util.shape(top_span_emb, 0)
         top_span_range = tf.range(k)  # [k]
         antecedent_offsets = tf.expand_dims(top_span_range, 1) - tf.expand_dims(top_span_range, 0)  # [k, k]
-        antecedents_mask = antecedent_offsets >= 1  # [k, k]
+        same_doc = tf.equal(tf.expand_dims(top_span_doc_ids, 1), tf.expand_dims(top_span_doc_ids, 0))  # [k, k]
+        antecedents_mask = tf.logical_and(antecedent_offsets >= 1, same_doc)  # [k, k]
         fast_antecedent_scores = tf.expand_dims(top_span_mention_scores, 1) + tf.expand_dims(top_span_mention_scores,
                                                                                              0)  # [k, k]
         fast_antecedent_scores += tf.log(tf.to_float(antecedents_mask))  # [k, k]
@@ -339,12 +528,13 @@ class CorefModel(object):
         top_antecedent_offsets = util.batch_gather(antecedent_offsets, top_antecedents)  # [k, c]
         return top_antecedents, top_antecedents_mask, top_fast_antecedent_scores, top_antecedent_offsets
 
-    def distance_pruning(self, top_span_emb, top_span_mention_scores, c):
+    def distance_pruning(self, top_span_emb, top_span_mention_scores, top_span_doc_ids, c):
         k = util.shape(top_span_emb, 0)
         top_antecedent_offsets = tf.tile(tf.expand_dims(tf.range(c) + 1, 0), [k, 1])  # [k, c]
         raw_top_antecedents = tf.expand_dims(tf.range(k), 1) - top_antecedent_offsets  # [k, c]
-        top_antecedents_mask = raw_top_antecedents >= 0  # [k, c]
         top_antecedents = tf.maximum(raw_top_antecedents, 0)  # [k, c]
+        same_doc = tf.equal(tf.expand_dims(top_span_doc_ids, 1), tf.gather(top_span_doc_ids, top_antecedents))  # [k, c]
+        top_antecedents_mask = tf.logical_and(raw_top_antecedents >= 0, same_doc)  # [k, c]
 
         top_fast_antecedent_scores = tf.expand_dims(top_span_mention_scores, 1) + tf.gather(top_span_mention_scores,
                                                                                             top_antecedents)  # [k, c]
@@ -404,8 +594,21 @@ class CorefModel(object):
 
         return lost
 
+    def get_sentence_max_word_lengths(self, tokens, text_len, doc_ids, num_docs, max_word_length):
+        # The max_word_length of tensorize_example for the document of each sentence (with a single document,
+        # possibly truncated, the whole width of char_index).
+        word_lengths = tf.strings.length(tokens, unit="UTF8_CHAR")  # [num_sentences, max_sentence_length]
+        sentence_starts = tf.minimum(tf.cumsum(text_len, exclusive=True), util.shape(doc_ids, 0) - 1)  # [num_sentences]
+        sentence_doc_ids = tf.gather(doc_ids, sentence_starts)  # [num_sentences]
+        doc_max_word_lengths = tf.unsorted_segment_max(tf.reduce_max(word_lengths, 1), sentence_doc_ids,
+                                                       num_docs)  # [num_docs]
+        doc_max_word_lengths = tf.maximum(doc_max_word_lengths, max(self.config["filter_widths"]))  # [num_docs]
+        sentence_max_word_lengths = tf.gather(doc_max_word_lengths, sentence_doc_ids)  # [num_sentences]
+        return tf.cond(tf.greater(num_docs, 1), lambda: sentence_max_word_lengths,
+                       lambda: tf.fill(tf.shape(text_len), max_word_length))  # [num_sentences]
+
     def get_predictions_and_loss(self, tokens, context_word_emb, head_word_emb, lm_emb, char_index, text_len,
-                                 speaker_ids, genre, is_training, gold_starts, gold_ends, cluster_ids):
+                                 speaker_ids, genre, is_training, gold_starts, gold_ends, cluster_ids, doc_ids):
         self.dropout = self.get_dropout(self.config["dropout_rate"], is_training)
         self.lexical_dropout = self.get_dropout(self.config["lexical_dropout_rate"], is_training)
         self.lstm_dropout = self.get_dropout(self.config["lstm_dropout_rate"], is_training)
@@ -423,15 +626,22 @@ class CorefModel(object):
             flattened_char_emb = tf.reshape(char_emb, [num_sentences * max_sentence_length, util.shape(char_emb, 2),
                                                        util.shape(char_emb,
                                                                   3)])  # [num_sentences * max_sentence_length, max_word_length, emb]
+            # In a batch, char_index is padded to the longest word of all the documents: pool each word over the
+            # positions of its own document only, as if it had been tensorized alone.
+            sentence_max_word_lengths = self.get_sentence_max_word_lengths(
+                tokens, text_len, doc_ids, util.shape(genre, 0), util.shape(char_index, 2))  # [num_sentences]
+            flattened_max_word_lengths = tf.reshape(tf.tile(tf.expand_dims(sentence_max_word_lengths, 1),
+                                                            [1, max_sentence_length]),
+                                                    [-1])  # [num_sentences * max_sentence_length]
             flattened_aggregated_char_emb = util.cnn(flattened_char_emb, self.config["filter_widths"], self.config[
-                "filter_size"])  # [num_sentences * max_sentence_length, emb]
+                "filter_size"], flattened_max_word_lengths)  # [num_sentences * max_sentence_length, emb]
             aggregated_char_emb = tf.reshape(flattened_aggregated_char_emb, [num_sentences, max_sentence_length,
                                                                              util.shape(flattened_aggregated_char_emb,
                                                                                         1)])  # [num_sentences, max_sentence_length, emb]
             context_emb_list.append(aggregated_char_emb)
             head_emb_list.append(aggregated_char_emb)
 
-        if not self.lm_file:
+        if self.lm_file is None and self.lm_extractor is None:
             elmo_module = hub.Module("https://tfhub.dev/google/elmo/2")
             lm_embeddings = elmo_module(
                 inputs={"tokens": tokens, "sequence_len": text_len},
@@ -440,17 +650,21 @@ class CorefModel(object):
             lm_emb = tf.stack([tf.concat([word_emb, word_emb], -1),
                                lm_embeddings["lstm_outputs1"],
                                lm_embeddings["lstm_outputs2"]], -1)  # [num_sentences, max_sentence_length, 1024, 3]
-        lm_emb_size = util.shape(lm_emb, 2)
-        lm_num_layers = util.shape(lm_emb, 3)
-        with tf.variable_scope("lm_aggregation"):
-            self.lm_weights = tf.nn.softmax(
-                tf.get_variable("lm_scores", [lm_num_layers], initializer=tf.constant_initializer(0.0)))
-            self.lm_scaling = tf.get_variable("lm_scaling", [], initializer=tf.constant_initializer(1.0))
-        flattened_lm_emb = tf.reshape(lm_emb, [num_sentences * max_sentence_length * lm_emb_size, lm_num_layers])
-        flattened_aggregated_lm_emb = tf.matmul(flattened_lm_emb, tf.expand_dims(self.lm_weights,
-                                                                                 1))  # [num_sentences * max_sentence_length * emb, 1]
-        aggregated_lm_emb = tf.reshape(flattened_aggregated_lm_emb, [num_sentences, max_sentence_length, lm_emb_size])
-        aggregated_lm_emb *= self.lm_scaling
+        if self.config["lm_premixed"]:
+            # Already weighted and scaled with the trained lm_aggregation variables.
+            aggregated_lm_emb = tf.squeeze(lm_emb, 3)  # [num_sentences, max_sentence_length, emb]
+        else:
+            lm_emb_size = util.shape(lm_emb, 2)
+            lm_num_layers = util.shape(lm_emb, 3)
+            with tf.variable_scope("lm_aggregation"):
+                self.lm_weights = tf.nn.softmax(
+                    tf.get_variable("lm_scores", [lm_num_layers], initializer=tf.constant_initializer(0.0)))
+                self.lm_scaling = tf.get_variable("lm_scaling", [], initializer=tf.constant_initializer(1.0))
+            flattened_lm_emb = tf.reshape(lm_emb, [num_sentences * max_sentence_length * lm_emb_size, lm_num_layers])
+            flattened_aggregated_lm_emb = tf.matmul(flattened_lm_emb, tf.expand_dims(self.lm_weights,
+                                                                                     1))  # [num_sentences * max_sentence_length * emb, 1]
+            aggregated_lm_emb = tf.reshape(flattened_aggregated_lm_emb, [num_sentences, max_sentence_length, lm_emb_size])
+            aggregated_lm_emb *= self.lm_scaling
         context_emb_list.append(aggregated_lm_emb)
 
         context_emb = tf.concat(context_emb_list, 2)  # [num_sentences, max_sentence_length, emb]
@@ -463,34 +677,36 @@ class CorefModel(object):
         context_outputs = self.lstm_contextualize(context_emb, text_len, text_len_mask)  # [num_words, emb]
         num_words = util.shape(context_outputs, 0)
 
+        num_docs = util.shape(genre, 0)
         genre_emb = tf.gather(tf.get_variable("genre_embeddings", [len(self.genres), self.config["feature_size"]]),
-                              genre)  # [emb]
+                              genre)  # [num_docs, emb]
 
         sentence_indices = tf.tile(tf.expand_dims(tf.range(num_sentences), 1),
                                    [1, max_sentence_length])  # [num_sentences, max_sentence_length]
         flattened_sentence_indices = self.flatten_emb_by_sentence(sentence_indices, text_len_mask)  # [num_words]
         flattened_head_emb = self.flatten_emb_by_sentence(head_emb, text_len_mask)  # [num_words]
 
-        candidate_starts = tf.tile(tf.expand_dims(tf.range(num_words), 1),
-                                   [1, self.max_span_width])  # [num_words, max_span_width]
-        candidate_ends = candidate_starts + tf.expand_dims(tf.range(self.max_span_width),
-                                                           0)  # [num_words, max_span_width]
-        candidate_start_sentence_indices = tf.gather(flattened_sentence_indices,
-                                                     candidate_starts)  # [num_words, max_span_width]
-        candidate_end_sentence_indices = tf.gather(flattened_sentence_indices, tf.minimum(candidate_ends,
-                                                                                          num_words - 1))  # [num_words, max_span_width]
-        candidate_mask = tf.logical_and(candidate_ends < num_words, tf.equal(candidate_start_sentence_indices,
-                                                                             candidate_end_sentence_indices))  # [num_words, max_span_width]
-        flattened_candidate_mask = tf.reshape(candidate_mask, [-1])  # [num_words * max_span_width]
-        candidate_starts = tf.boolean_mask(tf.reshape(candidate_starts, [-1]),
-                                           flattened_candidate_mask)  # [num_candidates]
-        candidate_ends = tf.boolean_mask(tf.reshape(candidate_ends, [-1]), flattened_candidate_mask)  # [num_candidates]
-        candidate_sentence_indices = tf.boolean_mask(tf.reshape(candidate_start_sentence_indices, [-1]),
-                                                     flattened_candidate_mask)  # [num_candidates]
-
+        candidate_starts, candidate_ends = self.get_candidate_spans(flattened_sentence_indices, text_len,
+                                                                    num_words)  # [num_candidates]
         candidate_cluster_ids, candidate_is_gold = self.get_candidate_labels(candidate_starts, candidate_ends, gold_starts, gold_ends,
                                                                              cluster_ids)  # [num_candidates]
 
+        if self.config["candidate_ratio"] > 0 and not self.config["use_gold_mentions"]:
+            # First pass: only the best candidates of a cheap scorer get span embeddings and mention scores.
+            candidate_prescores = self.get_candidate_prescores(context_outputs, candidate_starts,
+                                                               candidate_ends)  # [num_candidates]
+            self.candidate_prescore_loss = tf.losses.sigmoid_cross_entropy(candidate_is_gold, candidate_prescores)
+            kept_candidates = self.cap_candidates(candidate_prescores, tf.gather(doc_ids, candidate_starts),
+                                                  candidate_ends - candidate_starts + 1, doc_ids,
+                                                  num_docs)  # [num_kept_candidates]
+            candidate_starts = tf.gather(candidate_starts, kept_candidates)  # [num_candidates]
+            candidate_ends = tf.gather(candidate_ends, kept_candidates)  # [num_candidates]
+            candidate_cluster_ids = tf.gather(candidate_cluster_ids, kept_candidates)  # [num_candidates]
+            candidate_is_gold = tf.gather(candidate_is_gold, kept_candidates)  # [num_candidates]
+        else:
+            self.candidate_prescore_loss = None
+        candidate_sentence_indices = tf.gather(flattened_sentence_indices, candidate_starts)  # [num_candidates]
+
         candidate_span_emb = self.get_span_emb(flattened_head_emb, context_outputs, candidate_starts,
                                                candidate_ends)  # [num_candidates, emb]
         candidate_mention_scores = self.get_mention_scores(candidate_span_emb)  # [k, 1]
@@ -508,29 +724,53 @@ class CorefModel(object):
         if self.config['use_gold_mentions']:
 
            k = tf.to_int32(tf.shape(gold_starts)[0])
-           top_span_indices = coref_ops.extract_spans(candidate_starts, # need for sorting
-                                                      candidate_ends, # need for sorting
-                                                      gold_starts,
-                                                      gold_ends,
-                                                      True) # [1, k]
+           top_span_indices = coref_ops.extract_gold_spans(candidate_starts, # need for sorting
+                                                           candidate_ends, # need for sorting
+                                                           gold_starts,
+                                                           gold_ends,
+                                                           True) # [1, k]
+           top_span_indices.set_shape([1, None])
+           top_span_indices = tf.squeeze(top_span_indices, 0)  # [k]
 
 
         else:
 
-           k = tf.to_int32(tf.floor(tf.to_float(tf.shape(context_outputs)[0]) * self.config["top_span_ratio"]))
-           top_span_indices = coref_ops.extract_spans(tf.expand_dims(candidate_mention_scores_for_pruning, 0),
-                                                      tf.expand_dims(candidate_starts, 0),
-                                                      tf.expand_dims(candidate_ends, 0),
-                                                      tf.expand_dims(k, 0),
-                                                      util.shape(context_outputs, 0),
-                                                      True)  # [1, k]
+           # One row of candidates per document, padded with -inf scores: each document keeps its own top spans.
+           num_candidates = util.shape(candidate_starts, 0)
+           candidate_doc_ids = tf.gather(doc_ids, candidate_starts)  # [num_candidates]
+           doc_num_words = tf.unsorted_segment_sum(tf.ones_like(doc_ids), doc_ids, num_docs)  # [num_docs]
+           doc_num_candidates = tf.unsorted_segment_sum(tf.ones_like(candidate_doc_ids), candidate_doc_ids,
+                                                        num_docs)  # [num_docs]
+           doc_k = tf.to_int32(tf.floor(tf.to_float(doc_num_words) * self.config["top_span_ratio"]))  # [num_docs]
+           doc_k = tf.minimum(doc_k, doc_num_candidates)  # [num_docs]
+           doc_candidate_offsets = tf.cumsum(doc_num_candidates, exclusive=True)  # [num_docs]
+           max_doc_candidates = tf.reduce_max(doc_num_candidates)
+           doc_candidate_indices = tf.expand_dims(doc_candidate_offsets, 1) + tf.expand_dims(
+               tf.range(max_doc_candidates), 0)  # [num_docs, max_doc_candidates]
+           doc_candidate_mask = tf.sequence_mask(doc_num_candidates, max_doc_candidates)  # [num_docs, max_doc_candidates]
+           doc_candidate_indices = tf.minimum(doc_candidate_indices, num_candidates - 1)  # [num_docs, max_doc_candidates]
+           doc_candidate_scores = tf.where(doc_candidate_mask,
+                                           tf.gather(candidate_mention_scores_for_pruning, doc_candidate_indices),
+                                           tf.fill(tf.shape(doc_candidate_indices), float("-inf")))  # [num_docs, max_doc_candidates]
+           doc_top_span_indices = coref_ops.extract_spans(doc_candidate_scores,
+                                                          tf.gather(candidate_starts, doc_candidate_indices),
+                                                          tf.gather(candidate_ends, doc_candidate_indices),
+                                                          doc_k,
+                                                          num_words,
+                                                          True)  # [num_docs, max_k]
+           doc_top_span_indices.set_shape([None, None])
+           # Single-word spans are always candidates and never cross, so the doc_k selected spans are real candidates
+           # (scored above the -inf padding columns): the padding columns are dropped all the same.
+           doc_top_span_mask = tf.logical_and(
+               tf.sequence_mask(doc_k, util.shape(doc_top_span_indices, 1)),
+               doc_top_span_indices < tf.expand_dims(doc_num_candidates, 1))  # [num_docs, max_k]
+           doc_top_span_indices += tf.expand_dims(doc_candidate_offsets, 1)  # [num_docs, max_k]
+           top_span_indices = tf.boolean_mask(doc_top_span_indices, doc_top_span_mask)  # [k]
+           k = util.shape(top_span_indices, 0)
 
         #####
 
 
-        top_span_indices.set_shape([1, None])
-        top_span_indices = tf.squeeze(top_span_indices, 0)  # [k]
-
         top_span_starts = tf.gather(candidate_starts, top_span_indices)  # [k]
         top_span_ends = tf.gather(candidate_ends, top_span_indices)  # [k]
         top_span_emb = tf.gather(candidate_span_emb, top_span_indices)  # [k, emb]
@@ -539,6 +779,8 @@ class CorefModel(object):
         self.top_span_mention_scores = top_span_mention_scores
         top_span_sentence_indices = tf.gather(candidate_sentence_indices, top_span_indices)  # [k]
         top_span_speaker_ids = tf.gather(speaker_ids, top_span_starts)  # [k]
+        top_span_doc_ids = tf.gather(doc_ids, top_span_starts)  # [k]
+        top_span_genre_emb = tf.gather(genre_emb, top_span_doc_ids)  # [k, emb]
 
         cluster_id_to_first_mention_id = tf.unsorted_segment_min(tf.range(k), top_span_cluster_ids, k)
         mention_id_to_first_mention_id = tf.gather(cluster_id_to_first_mention_id, top_span_cluster_ids)
@@ -551,10 +793,10 @@ class CorefModel(object):
 
         if self.config["coarse_to_fine"]:
             top_antecedents, top_antecedents_mask, top_fast_antecedent_scores, top_antecedent_offsets = self.coarse_to_fine_pruning(
-                top_span_emb, top_span_mention_scores, c)
+                top_span_emb, top_span_mention_scores, top_span_doc_ids, c)
         else:
             top_antecedents, top_antecedents_mask, top_fast_antecedent_scores, top_antecedent_offsets = self.distance_pruning(
-                top_span_emb, top_span_mention_scores, c)
+                top_span_emb, top_span_mention_scores, top_span_doc_ids, c)
 
         dummy_scores = tf.zeros([k, 1])  # [k, 1]
         top_refined_emb = None
@@ -569,7 +811,7 @@ class CorefModel(object):
                                                                         top_antecedent_emb,
                                                                         top_antecedent_offsets,
                                                                         top_span_speaker_ids,
-                                                                        genre_emb,
+                                                                        top_span_genre_emb,
                                                                         top_antecedent_scores)  # [k, c]
                 top_antecedent_scores = tf.concat([dummy_scores, top_antecedent_scores], 1)  # [k, c + 1]
                 top_antecedent_weights = tf.nn.softmax(top_antecedent_scores)  # [k, c + 1]
@@ -649,11 +891,52 @@ class CorefModel(object):
             losses.append(self.antecedent_loss)
         if self.config['mention_loss']:
             losses.append(self.mention_loss)
+        if self.candidate_prescore_loss is not None:
+            losses.append(self.candidate_prescore_loss)
         loss = tf.add_n(losses)
 
         return [candidate_starts, candidate_ends, candidate_mention_scores, top_span_starts, top_span_ends,
                 top_antecedents, top_antecedent_scores], loss
 
+    def get_candidate_spans(self, flattened_sentence_indices, text_len, num_words):
+        # Spans of at most max_span_width words within a sentence, by start then width.
+        sentence_ends = tf.cumsum(text_len) - 1  # [num_sentences]
+        word_sentence_ends = tf.gather(sentence_ends, flattened_sentence_indices)  # [num_words]
+        word_num_candidates = tf.minimum(word_sentence_ends - tf.range(num_words) + 1,
+                                         self.max_span_width)  # [num_words]
+        word_candidate_ends = tf.cumsum(word_num_candidates)  # [num_words]
+        candidate_range = tf.range(word_candidate_ends[-1])  # [num_candidates]
+        candidate_starts = tf.searchsorted(word_candidate_ends, candidate_range, side="right")  # [num_candidates]
+        candidate_widths = candidate_range - tf.gather(word_candidate_ends - word_num_candidates,
+                                                       candidate_starts)  # [num_candidates]
+        return candidate_starts, candidate_starts + candidate_widths
+
+    def get_candidate_prescores(self, context_outputs, candidate_starts, candidate_ends):
+        # Cheap mention scores, from the first and last words and the width only.
+        with tf.variable_scope("candidate_prescores"):
+            boundary_scores = util.projection(context_outputs, 2)  # [num_words, 2]
+            width_scores = tf.get_variable("width_scores", [self.config["max_span_width"]],
+                                           initializer=tf.zeros_initializer())  # [max_span_width]
+        return (tf.gather(boundary_scores[:, 0], candidate_starts) + tf.gather(boundary_scores[:, 1], candidate_ends) +
+                tf.gather(width_scores, candidate_ends - candidate_starts))  # [num_candidates]
+
+    def cap_candidates(self, candidate_prescores, candidate_doc_ids, candidate_widths, doc_ids, num_docs):
+        # Indices (in order) of the best candidate_ratio * num_words candidates of each document, by first-pass
+        # score, and of all the single-word ones, so that top_span_ratio * num_words non-crossing spans remain.
+        doc_num_words = tf.unsorted_segment_sum(tf.ones_like(doc_ids), doc_ids, num_docs)  # [num_docs]
+        doc_caps = tf.to_int32(tf.ceil(tf.to_float(doc_num_words) * self.config["candidate_ratio"]))  # [num_docs]
+        doc_num_candidates = tf.unsorted_segment_sum(tf.ones_like(candidate_doc_ids), candidate_doc_ids,
+                                                     num_docs)  # [num_docs]
+        doc_candidate_offsets = tf.cumsum(doc_num_candidates, exclusive=True)  # [num_docs]
+        # By document, then by decreasing score.
+        by_score = tf.argsort(candidate_prescores, direction="DESCENDING", stable=True)  # [num_candidates]
+        by_doc = tf.gather(by_score, tf.argsort(tf.gather(candidate_doc_ids, by_score), stable=True))  # [num_candidates]
+        by_doc_doc_ids = tf.gather(candidate_doc_ids, by_doc)  # [num_candidates]
+        doc_ranks = tf.range(util.shape(by_doc, 0)) - tf.gather(doc_candidate_offsets, by_doc_doc_ids)  # [num_candidates]
+        kept = tf.logical_or(doc_ranks < tf.gather(doc_caps, by_doc_doc_ids),
+                             tf.equal(tf.gather(candidate_widths, by_doc), 1))  # [num_candidates]
+        return tf.sort(tf.boolean_mask(by_doc, kept))  # [num_kept_candidates]
+
     def get_span_emb(self, head_emb, context_outputs, span_starts, span_ends):
         span_emb_list = []
 
@@ -719,7 +1002,7 @@ class CorefModel(object):
                                                 top_antecedent_emb,
                                                 top_antecedent_offsets,
                                                 top_span_speaker_ids,
-                                                genre_emb):
+                                                top_span_genre_emb):
         k = util.shape(top_span_emb, 0)
         c = util.shape(top_antecedents, 1)
 
@@ -732,7 +1015,7 @@ class CorefModel(object):
                                          tf.to_int32(same_speaker))  # [k, c, emb]
             feature_emb_list.append(speaker_pair_emb)
 
-            tiled_genre_emb = tf.tile(tf.expand_dims(tf.expand_dims(genre_emb, 0), 0), [k, c, 1])  # [k, c, emb]
+            tiled_genre_emb = tf.tile(tf.expand_dims(top_span_genre_emb, 1), [1, c, 1])  # [k, c, emb]
             feature_emb_list.append(tiled_genre_emb)
 
         if self.config["use_features"]:
@@ -782,7 +1065,7 @@ class CorefModel(object):
         return slow_antecedent_scores  # [k, c]
 
     def get_slow_antecedent_scores(self, top_span_emb, top_antecedents, top_antecedent_emb, top_antecedent_offsets,
-                                   top_span_speaker_ids, genre_emb, prev_antecedent_scores=None):
+                                   top_span_speaker_ids, top_span_genre_emb, prev_antecedent_scores=None):
         k = util.shape(top_span_emb, 0)
         c = util.shape(top_antecedents, 1)
 
@@ -795,7 +1078,7 @@ class CorefModel(object):
                                          tf.to_int32(same_speaker))  # [k, c, emb]
             feature_emb_list.append(speaker_pair_emb)
 
-            tiled_genre_emb = tf.tile(tf.expand_dims(tf.expand_dims(genre_emb, 0), 0), [k, c, 1])  # [k, c, emb]
+            tiled_genre_emb = tf.tile(tf.expand_dims(top_span_genre_emb, 1), [1, c, 1])  # [k, c, emb]
             feature_emb_list.append(tiled_genre_emb)
 
         if self.config["use_features"]:
@@ -895,22 +1178,57 @@ class CorefModel(object):
         return self.flatten_emb_by_sentence(text_outputs, text_len_mask)
 
     def get_predicted_antecedents(self, antecedents, antecedent_scores):
-        predicted_antecedents = []
-        for i, index in enumerate(np.argmax(antecedent_scores, axis=1) - 1):
-            if index < 0:
-                predicted_antecedents.append(-1)
-            else:
-                predicted_antecedents.append(antecedents[i, index])
-        return predicted_antecedents
+        # Antecedent index of each span (-1: dummy antecedent).
+        indices = np.argmax(antecedent_scores, axis=1) - 1
+        predicted_antecedents = antecedents[np.arange(len(indices)), np.maximum(indices, 0)]
+        return np.where(indices < 0, -1, predicted_antecedents)
 
     def get_predicted_clusters(self, top_span_starts, top_span_ends, predicted_antecedents, include_singletons=False):
+        # Clusters of the antecedent links, and the cluster of each mention.
+        top_span_starts = np.asarray(top_span_starts)
+        top_span_ends = np.asarray(top_span_ends)
+        predicted_antecedents = np.asarray(predicted_antecedents, dtype=np.int64).reshape([-1])
+        num_spans = len(predicted_antecedents)
+        assert (predicted_antecedents < np.arange(num_spans)).all()
+        mentions = list(zip(top_span_starts.tolist(), top_span_ends.tolist()))
+        if len(set(mentions)) < num_spans:
+            # Duplicated spans (e.g. a gold mention in two clusters) share their cluster: see the loop below.
+            return self._get_predicted_clusters_by_mention(mentions, predicted_antecedents, include_singletons)
+
+        # Root (first span) of the cluster of each span, by pointer jumping: antecedents come first.
+        roots = np.where(predicted_antecedents < 0, np.arange(num_spans), predicted_antecedents)
+        while True:
+            next_roots = roots[roots]
+            if (next_roots == roots).all():
+                break
+            roots = next_roots
+
+        linked = np.flatnonzero(predicted_antecedents >= 0)
+        cluster_roots, first_links = np.unique(roots[linked], return_index=True)
+        cluster_roots = cluster_roots[np.argsort(first_links)]
+        cluster_ids = np.full(num_spans, -1, dtype=np.int64)
+        cluster_ids[cluster_roots] = np.arange(len(cluster_roots))
+        cluster_ids[linked] = cluster_ids[roots[linked]]
+        members = np.flatnonzero(cluster_ids >= 0)
+        members = members[np.argsort(cluster_ids[members], kind="stable")]
+        cluster_sizes = np.bincount(cluster_ids[members], minlength=len(cluster_roots))
+        predicted_clusters = [tuple(mentions[m] for m in cluster)
+                              for cluster in np.split(members, np.cumsum(cluster_sizes)[:-1])] if len(members) else []
+
+        if include_singletons or self.config['include_singletons']:
+            predicted_clusters.extend((mentions[m],) for m in np.flatnonzero(cluster_ids < 0))
+
+        mention_to_predicted = {m: pc for pc in predicted_clusters for m in pc}
+        return predicted_clusters, mention_to_predicted
+
+    def _get_predicted_clusters_by_mention(self, mentions, predicted_antecedents, include_singletons=False):
+        # One link at a time, for spans that may be duplicated.
         mention_to_predicted = {}
         predicted_clusters = []
         for i, predicted_index in enumerate(predicted_antecedents):
             if predicted_index < 0:
                 continue
-            assert i > predicted_index
-            predicted_antecedent = (int(top_span_starts[predicted_index]), int(top_span_ends[predicted_index]))
+            predicted_antecedent = mentions[predicted_index]
             if predicted_antecedent in mention_to_predicted:
                 predicted_cluster = mention_to_predicted[predicted_antecedent]
             else:
@@ -918,14 +1236,13 @@ class CorefModel(object):
                 predicted_clusters.append([predicted_antecedent])
                 mention_to_predicted[predicted_antecedent] = predicted_cluster
 
-            mention = (int(top_span_starts[i]), int(top_span_ends[i]))
+            mention = mentions[i]
             predicted_clusters[predicted_cluster].append(mention)
             mention_to_predicted[mention] = predicted_cluster
 
         #####
         if include_singletons or self.config['include_singletons']:
-            for i, predicted_index in enumerate(predicted_antecedents):
-              mention = (int(top_span_starts[i]), int(top_span_ends[i]))
+            for mention in mentions:
               if mention not in mention_to_predicted:
                  predicted_cluster = len(predicted_clusters)
                  mention_to_predicted[mention] = predicted_cluster
@@ -949,23 +1266,38 @@ class CorefModel(object):
         evaluator.update(predicted_clusters, gold_clusters, mention_to_predicted, mention_to_gold)
         return predicted_clusters
 
-    def load_eval_data(self):
-        if self.eval_data is None:
-            def load_line(line):
-                example = json.loads(line)
-                return self.tensorize_example(example, is_training=False), example
-
-            with open(self.config["eval_path"]) as f:
-                #self.eval_data = [load_line(l) for l in f.readlines()]
-                self.eval_data = [x for x in (load_line(l) for l in f.readlines()) if x[0] is not None]
-            num_words = sum(tensorized_example[2].sum() for tensorized_example, _ in self.eval_data)
-            print("Loaded {} eval examples.".format(len(self.eval_data)))
+    def load_eval_line(self, line):
+        example = util.loads_json(line)
+        return self.tensorize_example(example, is_training=False), example
+
+    def iter_eval_data(self):
+        # (tensorized example, example) pairs of the eval data, kept unless eval_streaming is set.
+        if self.eval_data is not None:
+            for tensorized_example, example in self.eval_data:
+                yield tensorized_example, example
+            return
+        keep_eval_data = not self.config["eval_streaming"]
+        eval_data = []
+        num_examples = 0
+        lines = util.JsonlinesReader(self.config["eval_path"]).iter_lines()
+        for tensorized_example, example in util.prefetch_map(self.load_eval_line, lines,
+                                                             self.config["tensorize_threads"],
+                                                             self.config["prefetch_documents"]):
+            if tensorized_example is not None:
+                num_examples += 1
+                if keep_eval_data:
+                    eval_data.append((tensorized_example, example))
+                yield tensorized_example, example
+        if keep_eval_data:
+            self.eval_data = eval_data
+        print("Loaded {} eval examples.".format(num_examples))
 
     def evaluate(self, session, official_stdout=False, pprint=False, test=False, outfpath=None):
-        self.load_eval_data()
+        num_examples = len(self.eval_data) if self.eval_data is not None else "?"
 
         coref_predictions = {}
         coref_evaluator = metrics.CorefEvaluator()
+        gold_docs = []  # Only what the mention metrics need.
 
         if not test:
             session.run(self.switch_to_test_mode_op)
@@ -973,13 +1305,16 @@ class CorefModel(object):
         if outfpath:
           fh = open(outfpath, 'w')
 
-        for example_num, (tensorized_example, example) in enumerate(self.eval_data):
-            _, _, _, _, _, _, _, _, _, gold_starts, gold_ends, _ = tensorized_example
+        def run_example(example_num, tensorized_example, example):
             feed_dict = {i: t for i, t in zip(self.input_tensors, tensorized_example)}
+            return example_num, example, session.run(self.predictions, feed_dict=feed_dict)
 
-            candidate_starts, candidate_ends, candidate_mention_scores, top_span_starts, top_span_ends, top_antecedents, top_antecedent_scores = session.run(
-                self.predictions, feed_dict=feed_dict)
+        def decode_example(predicted_example):
+            # Runs in a background thread, while the graph runs on the next document.
+            example_num, example, predictions = predicted_example
+            candidate_starts, candidate_ends, candidate_mention_scores, top_span_starts, top_span_ends, top_antecedents, top_antecedent_scores = predictions
 
+            gold_docs.append({"doc_key": example["doc_key"], "clusters": example["clusters"]})
             predicted_antecedents = self.get_predicted_antecedents(top_antecedents, top_antecedent_scores)
             coref_predictions[example["doc_key"]] = self.evaluate_coref(top_span_starts, top_span_ends,
                                                                         predicted_antecedents, example["clusters"],
@@ -994,7 +1329,7 @@ class CorefModel(object):
                 print('==================================================================')
 
             if example_num % 10 == 0:
-                print("Evaluated {}/{} examples.".format(example_num + 1, len(self.eval_data)))
+                print("Evaluated {}/{} examples.".format(example_num + 1, num_examples))
 
             ### save the jsonlines
             if outfpath:
@@ -1006,13 +1341,20 @@ class CorefModel(object):
                fh.write(json.dumps(copy)+"\n")
             ###
 
+        predicted_examples = (run_example(example_num, tensorized_example, example)
+                              for example_num, (tensorized_example, example) in enumerate(self.iter_eval_data()))
+        # Decoding updates the evaluators and the output file in order: one thread at most (none with tensorize_threads = 0).
+        decode_threads = 1 if self.config["tensorize_threads"] > 0 else 0
+        for _ in util.prefetch_map(decode_example, predicted_examples, decode_threads):
+            pass
+
         if outfpath:
           fh.close()
 
         if not test:
             session.run(self.switch_to_train_mode_op)
 
-        mention_p, mention_r, mention_f = metrics.get_prf_mentions_for_all_documents([e[1] for e in self.eval_data], coref_predictions)
+        mention_p, mention_r, mention_f = metrics.get_prf_mentions_for_all_documents(gold_docs, coref_predictions)
 
         summary_dict = {}
 
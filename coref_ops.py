@@ -9,3 +9,6 @@ coref_op_library = tf.load_op_library("./coref_kernels.so")
 
 extract_spans = coref_op_library.extract_spans
 tf.NotDifferentiable("ExtractSpans")
+
+extract_gold_spans = coref_op_library.extract_gold_spans
+tf.NotDifferentiable("ExtractGoldSpans")
@@ -1,12 +0,0 @@
-from __future__ import absolute_import
-from __future__ import division
-from __future__ import print_function
-
-import tensorflow as tf
-from tensorflow.python import pywrap_tensorflow
-
-#coref_op_library = tf.load_op_library("./coref_kernels.so")
-coref_op_library = tf.load_op_library("./coref_kernels_gold_mentions.so")
-
-extract_spans = coref_op_library.extract_spans
-tf.NotDifferentiable("ExtractSpans")
@@ -42,7 +42,7 @@ def run_1model(eval_path):
   config = util.initialize_from_env(args.experiment, args.logdir)
   config['eval_path'] = eval_path
 
-  model = cm.CorefModel(config, eval_mode=True)
+  model = cm.CorefModel(config, eval_mode=True, use_tensorize_cache=True)
   with tf.Session() as session:
     model.restore(session, args.latest_checkpoint)
     model.evaluate(session, official_stdout=True, pprint=False, test=True, outfpath=outfpath)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+
+import tensorflow as tf
+
+import util
+
+
+def read_lm_mix(checkpoint_path, ema=False):
+  """Returns the softmaxed layer weights and the scaling of the `lm_aggregation` scope of a checkpoint."""
+  reader = tf.train.load_checkpoint(checkpoint_path)
+  names = ["lm_aggregation/lm_scores", "lm_aggregation/lm_scaling"]
+  if ema:
+    names = [name + "/ExponentialMovingAverage" for name in names]
+  scores, scaling = (reader.get_tensor(name) for name in names)
+  return util.softmax(scores, axis=-1), float(scaling)
+
+
+if __name__ == "__main__":
+  # predict.py restores the raw weights, evaluate.py their moving averages (--ema).
+  ema = "--ema" in sys.argv
+  sys.argv = [a for a in sys.argv if a != "--ema"]
+  args = util.get_args()
+  config = util.initialize_from_env(args.experiment, args.logdir)
+
+  if args.latest_checkpoint:
+    checkpoint_path = tf.train.latest_checkpoint(config["log_dir"])
+  else:
+    checkpoint_path = os.path.join(config["log_dir"], "model.max.ckpt")
+
+  weights, scaling = read_lm_mix(checkpoint_path, ema=ema)
+  output_filename = util.get_lm_mix_path(config["log_dir"])
+  with open(output_filename, "w") as f:
+    json.dump(dict(checkpoint=checkpoint_path, ema=ema, weights=weights.tolist(), scaling=scaling), f)
+  print("Layer weights: {}, scaling: {:.4f}".format(weights, scaling))
+  print("Wrote {}.".format(output_filename))
@@ -23,14 +23,15 @@ import functools
 import os
 import codecs
 import collections
+import itertools
 
 import h5py
-import json
 import re
 from tqdm import tqdm
 
 import modeling
 import tokenization
+import util
 import tensorflow as tf
 import numpy as np
 
@@ -98,6 +99,28 @@ flags.DEFINE_string("tokenization_module", None,
 flags.DEFINE_string("genres", None,
                     "Comma separated list of genres.")
 
+flags.DEFINE_string(
+    "compression", None,
+    "HDF5 compression filter of the features (`gzip` or `lzf`). "
+    "Features are not compressed by default.")
+
+flags.DEFINE_enum(
+    "precision", "float32", list(util.LM_PRECISIONS),
+    "Storage precision of the features: `float16` halves the file size, "
+    "`int8` (one float32 scale per token and layer) quarters it. "
+    "The model converts them back to float32 when loading them.")
+
+flags.DEFINE_string(
+    "lm_mix_file", None,
+    "Layer weights written by export_lm_mix.py. If set, a single layer, "
+    "mixed with these weights, is stored for each token (for models "
+    "configured with `lm_premixed`).")
+
+flags.DEFINE_integer(
+    "chunk_tokens", 0,
+    "Number of tokens per HDF5 chunk. 0 stores each document contiguously "
+    "(or lets h5py choose if `compression` is set).")
+
 
 def input_fn_builder(examples, window_size, stride, tokenizer):
     """Creates an `input_fn` closure to be passed to TPUEstimator."""
@@ -261,6 +284,144 @@ def convert_examples_to_features(examples, window_size, stride, tokenizer):
                                                window_size)
 
 
+class FeatureWriter(object):
+    """
+    Writes the features of each document as a [num_tokens, hidden_size,
+    num_layers] "embeddings" dataset and the [num_sentences + 1]
+    "sentence_offsets" of its sentences, in a group named after the doc key.
+    With the int8 precision, the group also has a [num_tokens, num_layers]
+    "scales" dataset (see `util.quantize_lm_emb`).
+
+    The features of the current document are buffered in memory and written in
+    one go when the next document starts (predictions come document by
+    document) or when the writer is closed.  A document replaces any previous
+    one with the same doc key.
+    """
+
+    def __init__(self, filename, hidden_size, num_layers, precision="float32", compression=None, chunk_tokens=0):
+        self._file = h5py.File(filename, 'w')
+        self._hidden_size = hidden_size
+        self._num_layers = num_layers
+        self._precision = precision
+        self._compression = compression
+        self._chunk_tokens = chunk_tokens
+        self._file_key = None
+        self._embeddings = None
+        self._sentence_offsets = None
+
+    def add(self, file_key, orig_example, token_indices, layer_outputs):
+        """Adds the [len(token_indices), hidden_size, num_layers] `layer_outputs` of a document."""
+        if file_key != self._file_key:
+            self.flush()
+            self._file_key = file_key
+            self._embeddings = np.zeros([len(orig_example.tokens), self._hidden_size, self._num_layers],
+                                        dtype=np.float32)
+            self._sentence_offsets = np.cumsum([0] + [len(s) for s in orig_example.sentence_tokens])
+        self._embeddings[token_indices] = layer_outputs
+
+    def flush(self):
+        if self._file_key is None:
+            return
+        options = {}
+        if self._compression:
+            options["compression"] = self._compression
+        if self._chunk_tokens > 0:
+            options["chunks"] = (min(self._chunk_tokens, len(self._embeddings)), self._hidden_size, self._num_layers)
+        embeddings, scales = util.quantize_lm_emb(self._embeddings, self._precision)
+        # A doc key repeated (e.g. across input files): the last document wins.
+        if self._file_key in self._file:
+            del self._file[self._file_key]
+        self._file.create_dataset("{}/embeddings".format(self._file_key), data=embeddings, **options)
+        self._file.create_dataset("{}/sentence_offsets".format(self._file_key), data=self._sentence_offsets)
+        if scales is not None:
+            self._file.create_dataset("{}/scales".format(self._file_key), data=scales)
+        self._file_key = None
+        self._embeddings = None
+        self._sentence_offsets = None
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+class BertFeatureExtractor(object):
+    """
+    Keeps a BERT encoder loaded, in its own graph and session, and computes the
+    features of a document in memory, with the same windows as `main`.
+
+    It is passed to `CorefModel` (`lm_extractor`) in place of an HDF5 features
+    file, so that predicting doesn't start an extraction process, reload BERT
+    and write and read back a temporary file for each input.
+    """
+
+    def __init__(self, bert_model_path, genres, layers=(-1, -2, -3, -4), window_size=129, stride=1,
+                 batch_size=32, do_lower_case=False, lm_mix=None, session_config=None):
+        """`lm_mix` is an optional (weights, scaling) pair (see `util.load_lm_mix`)."""
+        bert_config = modeling.BertConfig.from_json_file(os.path.join(bert_model_path, "bert_config.json"))
+        init_checkpoint = os.path.join(bert_model_path, "bert_model.ckpt")
+        self._tokenizer = tokenization.FullTokenizer(
+            vocab_file=os.path.join(bert_model_path, "vocab.txt"), do_lower_case=do_lower_case)
+        self._genres = {g: i for i, g in enumerate(genres)}
+        self._window_size = window_size
+        self._stride = stride
+        self._batch_size = batch_size
+        self._hidden_size = bert_config.hidden_size
+        self._lm_mix = lm_mix
+        if lm_mix is not None and len(lm_mix[0]) != len(layers):
+            raise ValueError("{} layer weights, {} layers are extracted".format(len(lm_mix[0]), len(layers)))
+        self.num_layers = 1 if lm_mix is not None else len(layers)
+
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            self._input_ids = tf.placeholder(tf.int32, [None, window_size])
+            self._input_mask = tf.placeholder(tf.int32, [None, window_size])
+            self._input_type_ids = tf.placeholder(tf.int32, [None, window_size])
+            model = modeling.BertModel(
+                config=bert_config,
+                is_training=False,
+                input_ids=self._input_ids,
+                input_mask=self._input_mask,
+                token_type_ids=self._input_type_ids,
+                use_one_hot_embeddings=False)
+            all_layers = model.get_all_encoder_layers()
+            self._layer_outputs = tf.stack([all_layers[i] for i in layers], -1)  # [batch, window_size, hidden_size, num_layers]
+            assignment_map, _ = modeling.get_assignment_map_from_checkpoint(tf.trainable_variables(), init_checkpoint)
+            tf.train.init_from_checkpoint(init_checkpoint, assignment_map)
+            self._session = tf.Session(graph=self._graph, config=session_config)
+            self._session.run(tf.global_variables_initializer())
+        self._graph.finalize()
+
+    def extract(self, example):
+        """Returns the [num_sentences, max_sentence_length, hidden_size, num_layers] features of a jsonlines example."""
+        orig_example = process_example(example, 0, should_filter_embedded_mentions=True, genres=self._genres)
+        bert_example = orig_example.bertify(self._tokenizer)
+        features = list(convert_examples_to_features([bert_example], self._window_size, self._stride, self._tokenizer))
+
+        embeddings = np.zeros([len(orig_example.tokens), self._hidden_size, self.num_layers], dtype=np.float32)
+        for batch_start in range(0, len(features), self._batch_size):
+            batch = features[batch_start:batch_start + self._batch_size]
+            layer_outputs = self._session.run(self._layer_outputs, feed_dict={
+                self._input_ids: [f["input_ids"] for f in batch],
+                self._input_mask: [f["input_mask"] for f in batch],
+                self._input_type_ids: [f["input_type_ids"] for f in batch]})
+            for f, window_outputs in zip(batch, layer_outputs):
+                extract_indices = np.asarray(f["extract_indices"])
+                output_indices = np.flatnonzero(extract_indices >= 0)
+                if not len(output_indices):
+                    continue
+                token_indices = [bert_example.bert_to_orig_map[i] for i in extract_indices[output_indices]]
+                window_outputs = window_outputs[output_indices]  # [num_extracted, hidden_size, num_layers]
+                if self._lm_mix is not None:
+                    window_outputs = util.mix_lm_layers(window_outputs, *self._lm_mix)
+                embeddings[token_indices] = window_outputs
+
+        sentence_offsets = np.cumsum([0] + [len(s) for s in orig_example.sentence_tokens])
+        return util.pad_by_sentence(embeddings, sentence_offsets)
+
+    def close(self):
+        self._session.close()
+
+
 def main(_):
 
 
@@ -286,23 +447,23 @@ def main(_):
             per_host_input_for_training=is_per_host))
 
     # examples = read_examples(FLAGS.input_file)
-    json_examples = []
     #for x in ['test', 'train', 'dev']:
     #    with open(os.path.join(FLAGS.input_file, x + '.english.jsonlines')) as f:
     #        json_examples.extend((json.loads(jsonline) for jsonline in f.readlines()))
-    for x in FLAGS.input_file.split(','):
-         x = x.strip()
-         with open(x) as f:
-             json_examples.extend((json.loads(jsonline) for jsonline in f.readlines()))
+    json_examples = itertools.chain.from_iterable(
+        util.JsonlinesReader(x.strip()) for x in FLAGS.input_file.split(','))
 
     genres = {g: i for i, g in enumerate(FLAGS.genres.split(','))}
 
-    orig_examples = []
-    bert_examples = []
-    for i, json_e in enumerate(json_examples):
-        e = process_example(json_e, i, should_filter_embedded_mentions=True, genres=genres)
-        orig_examples.append(e)
-        bert_examples.append(e.bertify(tokenizer))
+    # Documents are read as the estimator asks for them, and dropped once their features are written.
+    pending_examples = {}
+
+    def iter_bert_examples():
+        for i, json_e in enumerate(json_examples):
+            e = process_example(json_e, i, should_filter_embedded_mentions=True, genres=genres)
+            bert_example = e.bertify(tokenizer)
+            pending_examples[i] = (e, bert_example)
+            yield bert_example
 
     model_fn = model_fn_builder(
         bert_config=bert_config,
@@ -321,35 +482,41 @@ def main(_):
         train_batch_size=FLAGS.batch_size)
 
     input_fn = input_fn_builder(
-        examples=bert_examples, window_size=FLAGS.window_size, stride=FLAGS.stride, tokenizer=tokenizer)
-
-    writer = h5py.File(FLAGS.output_file, 'w')
-    with tqdm(total=sum(len(e.tokens) for e in orig_examples)) as t:
+        examples=iter_bert_examples(), window_size=FLAGS.window_size, stride=FLAGS.stride, tokenizer=tokenizer)
+
+    if FLAGS.lm_mix_file:
+        lm_weights, lm_scaling = util.load_lm_mix(FLAGS.lm_mix_file)
+        if len(lm_weights) != len(layer_indexes):
+            raise ValueError("{} has {} layer weights, {} layers are extracted".format(
+                FLAGS.lm_mix_file, len(lm_weights), len(layer_indexes)))
+
+    writer = FeatureWriter(FLAGS.output_file,
+                           hidden_size=bert_config.hidden_size,
+                           num_layers=1 if FLAGS.lm_mix_file else len(layer_indexes),
+                           precision=FLAGS.precision,
+                           compression=FLAGS.compression,
+                           chunk_tokens=FLAGS.chunk_tokens)
+    first_pending_index = 0
+    with tqdm(unit="tokens") as t:
         for result in estimator.predict(input_fn, yield_single_examples=True):
             document_index = int(result["unique_ids"])
-            bert_example = bert_examples[document_index]
-            orig_example = orig_examples[document_index]
+            while first_pending_index < document_index:
+                pending_examples.pop(first_pending_index, None)
+                first_pending_index += 1
+            orig_example, bert_example = pending_examples[document_index]
             file_key = bert_example.doc_key.replace('/', ':')
 
-            t.update(n=(result['extract_indices'] >= 0).sum())
-
-            for output_index, bert_token_index in enumerate(result['extract_indices']):
-                if bert_token_index < 0:
-                    continue
-
-                token_index = bert_example.bert_to_orig_map[bert_token_index]
-                sentence_index, token_index = orig_example.unravel_token_index(token_index)
-
-                dataset_key ="{}/{}".format(file_key, sentence_index)
-                if dataset_key not in writer:
-                    writer.create_dataset(dataset_key,
-                                          (len(orig_example.sentence_tokens[sentence_index]), bert_config.hidden_size, len(layer_indexes)),
-                                          dtype=np.float32)
-
-                dset = writer[dataset_key]
-                for j, layer_index in enumerate(layer_indexes):
-                    layer_output = result["layer_output_%d" % j]
-                    dset[token_index, :, j] = layer_output[output_index]
+            output_indices = np.flatnonzero(result['extract_indices'] >= 0)
+            t.update(n=len(output_indices))
+            if not len(output_indices):
+                continue
+
+            token_indices = [bert_example.bert_to_orig_map[i] for i in result['extract_indices'][output_indices]]
+            layer_outputs = np.stack([result["layer_output_%d" % j][output_indices]
+                                      for j in range(len(layer_indexes))], -1)  # [num_extracted, hidden_size, num_layers]
+            if FLAGS.lm_mix_file:
+                layer_outputs = util.mix_lm_layers(layer_outputs, lm_weights, lm_scaling)  # [num_extracted, hidden_size, 1]
+            writer.add(file_key, orig_example, token_indices, layer_outputs)
     writer.close()
 
 
@@ -0,0 +1,163 @@
+#ifndef COREF_EXTRACT_SPANS_H_
+#define COREF_EXTRACT_SPANS_H_
+
+#include <algorithm>
+#include <cstdint>
+#include <limits>
+#include <numeric>
+#include <unordered_map>
+#include <vector>
+
+namespace coref {
+
+// Greedy span selection of the ExtractSpans op, for one row of candidates.
+//
+// Candidates are taken by decreasing score (ties: by index), skipping those
+// that cross an already selected span, until `num_output_spans` are selected.
+// Only the best candidates are ordered (by chunks of partial selection, twice
+// as large each time crossings exhaust the previous chunk), and the selected
+// spans are tracked in flat arrays indexed by token instead of hash maps.
+//
+// Writes the indices of the selected spans to `output_span_indices`
+// (sorted by start, end and index if `sort_spans`, else by selection), then
+// pads it up to `num_output_columns` with the first index.  Returns the
+// number of selected spans.
+inline int ExtractSpans(const float* span_scores,
+                        const int32_t* candidate_starts,
+                        const int32_t* candidate_ends,
+                        int num_input_spans,
+                        int num_output_spans,
+                        bool sort_spans,
+                        int num_output_columns,
+                        int32_t* output_span_indices) {
+  num_output_spans = std::max(0, std::min(num_output_spans, num_input_spans));
+  int num_selected_spans = 0;
+
+  if (num_output_spans > 0) {
+    int min_position = std::numeric_limits<int>::max();
+    int max_position = 0;
+    for (int i = 0; i < num_input_spans; ++i) {
+      min_position = std::min(min_position, static_cast<int>(candidate_starts[i]));
+      max_position = std::max(max_position, static_cast<int>(candidate_ends[i]));
+    }
+    // Latest end of the selected spans starting at each token (-1: none), and
+    // earliest start of those ending there (max int: none).
+    const int num_positions = max_position - min_position + 1;
+    std::vector<int> start_to_latest_end(num_positions, -1);
+    std::vector<int> end_to_earliest_start(num_positions, std::numeric_limits<int>::max());
+
+    std::vector<int> sorted_indices(num_input_spans);
+    std::iota(sorted_indices.begin(), sorted_indices.end(), 0);
+    auto by_score = [span_scores](int i1, int i2) {
+      return span_scores[i1] > span_scores[i2] || (span_scores[i1] == span_scores[i2] && i1 < i2);
+    };
+
+    int chunk_begin = 0;
+    int chunk_size = num_output_spans;
+    while (num_selected_spans < num_output_spans && chunk_begin < num_input_spans) {
+      const int chunk_end = std::min(num_input_spans, chunk_begin + chunk_size);
+      if (chunk_end < num_input_spans) {
+        std::nth_element(sorted_indices.begin() + chunk_begin, sorted_indices.begin() + chunk_end,
+                         sorted_indices.end(), by_score);
+      }
+      std::sort(sorted_indices.begin() + chunk_begin, sorted_indices.begin() + chunk_end, by_score);
+
+      for (int s = chunk_begin; s < chunk_end && num_selected_spans < num_output_spans; ++s) {
+        const int i = sorted_indices[s];
+        const int start = candidate_starts[i] - min_position;
+        const int end = candidate_ends[i] - min_position;
+        bool any_crossing = false;
+        for (int j = start; j <= end; ++j) {
+          if (j > start && start_to_latest_end[j] > end) {
+            // Given (), exists [], such that ( [ ) ]
+            any_crossing = true;
+            break;
+          }
+          if (j < end && end_to_earliest_start[j] < start) {
+            // Given (), exists [], such that [ ( ] )
+            any_crossing = true;
+            break;
+          }
+        }
+        if (!any_crossing) {
+          output_span_indices[num_selected_spans++] = i;
+          start_to_latest_end[start] = std::max(start_to_latest_end[start], end);
+          end_to_earliest_start[end] = std::min(end_to_earliest_start[end], start);
+        }
+      }
+      chunk_begin = chunk_end;
+      chunk_size *= 2;
+    }
+
+    if (sort_spans) {
+      std::sort(output_span_indices, output_span_indices + num_selected_spans,
+                [candidate_starts, candidate_ends](int i1, int i2) {
+                  if (candidate_starts[i1] != candidate_starts[i2]) {
+                    return candidate_starts[i1] < candidate_starts[i2];
+                  } else if (candidate_ends[i1] != candidate_ends[i2]) {
+                    return candidate_ends[i1] < candidate_ends[i2];
+                  } else {
+                    return i1 < i2;
+                  }
+                });
+    }
+  }
+
+  // Pad with the first span index.
+  const int32_t padding = num_selected_spans > 0 ? output_span_indices[0] : 0;
+  for (int i = num_selected_spans; i < num_output_columns; ++i) {
+    output_span_indices[i] = padding;
+  }
+  return num_selected_spans;
+}
+
+// Span selection of the ExtractGoldSpans op: the index of the (first)
+// candidate of each gold span, found through a hash table of the candidates.
+//
+// Writes them to `output_span_indices` (sorted by start, end and index if
+// `sort_spans`, else in the order of the gold spans).  Returns the number of
+// gold spans found among the candidates (the first ones, if not all are).
+inline int ExtractGoldSpans(const int32_t* candidate_starts,
+                            const int32_t* candidate_ends,
+                            int num_candidates,
+                            const int32_t* gold_starts,
+                            const int32_t* gold_ends,
+                            int num_gold_spans,
+                            bool sort_spans,
+                            int32_t* output_span_indices) {
+  auto span_key = [](int32_t start, int32_t end) {
+    return (static_cast<int64_t>(start) << 32) | static_cast<uint32_t>(end);
+  };
+  std::unordered_map<int64_t, int> span_to_candidate;
+  span_to_candidate.reserve(num_candidates);
+  for (int i = 0; i < num_candidates; ++i) {
+    span_to_candidate.emplace(span_key(candidate_starts[i], candidate_ends[i]), i);
+  }
+
+  int num_found_spans = 0;
+  for (int j = 0; j < num_gold_spans; ++j) {
+    auto candidate_iter = span_to_candidate.find(span_key(gold_starts[j], gold_ends[j]));
+    if (candidate_iter == span_to_candidate.end()) {
+      break;
+    }
+    output_span_indices[num_found_spans++] = candidate_iter->second;
+  }
+
+  if (sort_spans) {
+    std::sort(output_span_indices, output_span_indices + num_found_spans,
+              [candidate_starts, candidate_ends](int i1, int i2) {
+                if (candidate_starts[i1] != candidate_starts[i2]) {
+                  return candidate_starts[i1] < candidate_starts[i2];
+                } else if (candidate_ends[i1] != candidate_ends[i2]) {
+                  return candidate_ends[i1] < candidate_ends[i2];
+                } else {
+                  return i1 < i2;
+                }
+              });
+  }
+  return num_found_spans;
+}
+
+}  // namespace coref
+
+#endif  // COREF_EXTRACT_SPANS_H_
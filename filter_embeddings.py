@@ -3,7 +3,8 @@ from __future__ import division
 from __future__ import print_function
 
 import sys
-import json
+
+import util
 
 if __name__ == "__main__":
   if len(sys.argv) < 3:
@@ -11,10 +12,9 @@ if __name__ == "__main__":
 
   words_to_keep = set()
   for json_filename in sys.argv[2:]:
-    with open(json_filename) as json_file:
-      for line in json_file.readlines():
-        for sentence in json.loads(line)["sentences"]:
-          words_to_keep.update(sentence)
+    for example in util.JsonlinesReader(json_filename):
+      for sentence in example["sentences"]:
+        words_to_keep.update(sentence)
 
   print("Found {} words in {} dataset(s).".format(len(words_to_keep), len(sys.argv) - 2))
 
@@ -23,7 +23,7 @@ if __name__ == "__main__":
   out_filename = "{}.filtered".format(sys.argv[1])
   with open(sys.argv[1]) as in_file:
     with open(out_filename, "w") as out_file:
-      for line in in_file.readlines():
+      for line in in_file:
         total_lines += 1
         word = line.split()[0]
         if word in words_to_keep:
@@ -2,16 +2,15 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import json
+import util
 
 def get_char_vocab(input_filenames, output_filename):
   vocab = set()
   for filename in input_filenames:
-    with open(filename) as f:
-      for line in f.readlines():
-        for sentence in json.loads(line)["sentences"]:
-          for word in sentence:
-            vocab.update(word)
+    for example in util.JsonlinesReader(filename):
+      for sentence in example["sentences"]:
+        for word in sentence:
+          vocab.update(word)
   vocab = sorted(list(vocab))
   with open(output_filename, "w") as f:
     for char in vocab:
@@ -6,10 +6,16 @@ import os
 import sys
 import json
 import subprocess
+import multiprocessing
 
 import tensorflow as tf
 import coref_model as cm
 import util
+from extract_features import BertFeatureExtractor
+
+
+BERT_WINDOW_SIZE = 129
+BERT_STRIDE = 1
 
 
 def bertify(fn, outfn, config):
@@ -21,63 +27,204 @@ def bertify(fn, outfn, config):
     f"--init_checkpoint={config['bert_model_path']}/bert_model.ckpt",
     f"--vocab_file={config['bert_model_path']}/vocab.txt",
     "--do_lower_case=False",
-    "--stride=1",
-    "--window_size=129",
+    f"--stride={BERT_STRIDE}",
+    f"--window_size={BERT_WINDOW_SIZE}",
     "--genres=" + ",".join(config['genres']),
   ]
+  if config['lm_premixed']:
+    args.append(f"--lm_mix_file={util.get_lm_mix_path(config['log_dir'])}")
   env = os.environ.copy()
   env['PYTHONPATH'] = "."
   subprocess.run(args, env=env, check=True)
 
 
+def make_lm_extractor(config, session_config=None):
+  """BERT encoder kept in this process, in place of `bertify` and its features file."""
+  lm_mix = util.load_lm_mix(util.get_lm_mix_path(config['log_dir'])) if config['lm_premixed'] else None
+  return BertFeatureExtractor(
+    config['bert_model_path'],
+    genres=config['genres'],
+    window_size=BERT_WINDOW_SIZE,
+    stride=BERT_STRIDE,
+    do_lower_case=False,
+    lm_mix=lm_mix,
+    session_config=session_config,
+  )
+
+
+def tensorize_lines(model, lines, cluster_key):
+  """
+  First stage of the prediction of a batch of jsonlines: returns the examples,
+  those the model can predict, and their tensors (packed into a single input
+  if there are several) with the word offsets of their documents (None for a
+  single document).  The other examples get no clusters.
+  """
+  examples = [util.loads_json(line) for line in lines]
+  batch_examples = []
+  tensorized_examples = []
+  for example in examples:
+    tensorized_example = model.tensorize_example(example, is_training=False)
+    if tensorized_example is None:
+      example[cluster_key] = []
+    else:
+      batch_examples.append(example)
+      tensorized_examples.append(tensorized_example)
+
+  if len(tensorized_examples) > 1:
+    tensors, word_offsets = model.tensorize_batch(tensorized_examples)
+  elif tensorized_examples:
+    tensors, word_offsets = tensorized_examples[0], None
+  else:
+    tensors, word_offsets = None, None
+  return examples, batch_examples, tensors, word_offsets
+
+
+def run_model(model, session, tensors):
+  """Second stage: returns the top span starts and ends, the top antecedents and their scores."""
+  if tensors is None:
+    return None
+  feed_dict = {i:t for i,t in zip(model.input_tensors, tensors)}
+  _, _, _, top_span_starts, top_span_ends, top_antecedents, top_antecedent_scores = session.run(model.predictions, feed_dict=feed_dict)
+  return top_span_starts, top_span_ends, top_antecedents, top_antecedent_scores
 
 
-def run(config, input_filename, output_filename, cluster_key):
+def decode_predictions(model, examples, batch_examples, predictions, word_offsets, cluster_key):
+  """Last stage: adds the predicted clusters to the examples and returns them as jsonlines."""
+  if predictions is not None:
+    if word_offsets is None:
+      doc_predictions = [predictions]
+    else:
+      doc_predictions = model.split_batch_predictions(*predictions, word_offsets)
+    for example, (top_span_starts, top_span_ends, top_antecedents, top_antecedent_scores) in zip(batch_examples, doc_predictions):
+      predicted_antecedents = model.get_predicted_antecedents(top_antecedents, top_antecedent_scores)
+      example[cluster_key], _ = model.get_predicted_clusters(top_span_starts, top_span_ends, predicted_antecedents)
 
-  model = cm.CorefModel(config)
+  for example in examples:
+    if cluster_key == "predicted_clusters" and "clusters" in example:
+       del example["clusters"]
+  return [json.dumps(example) for example in examples]
+
+
+def predict_lines(model, session, lines, cluster_key, batch_size=1, num_threads=0, prefetch_documents=1):
+  """
+  Yields the input jsonlines with their predicted clusters, in order.  Each run
+  of the model predicts `batch_size` documents.  With `num_threads` > 0, the
+  next `prefetch_documents` documents are tensorized in as many background
+  threads and the predictions are decoded in another thread, while the model
+  runs in this one.
+  """
+  batches = util.iter_batches(lines, batch_size)
+  prefetch_batches = max(1, prefetch_documents // batch_size)
+  tensorized_batches = util.prefetch_map(lambda batch: tensorize_lines(model, batch, cluster_key), batches,
+                                         num_threads, prefetch_batches)
+  predicted_batches = ((examples, batch_examples, run_model(model, session, tensors), word_offsets)
+                       for examples, batch_examples, tensors, word_offsets in tensorized_batches)
+  # The outputs are yielded in order: a single decoding thread is enough (none with num_threads = 0).
+  decode_threads = 1 if num_threads > 0 else 0
+  decoded_batches = util.prefetch_map(lambda predicted: decode_predictions(model, *predicted, cluster_key),
+                                      predicted_batches, decode_threads, 1)
+  for output_lines in decoded_batches:
+    yield from output_lines
+
+
+def run(config, input_filename, output_filename, cluster_key, lm_extractor=None, batch_size=1):
+
+  model = cm.CorefModel(config, lm_extractor=lm_extractor)
 
   with tf.Session() as session:
     model.restore(session)
 
     with open(output_filename, "w") as output_file:
-      with open(input_filename) as input_file:
-        for example_num, line in enumerate(input_file.readlines()):
-          example = json.loads(line)
-          tensorized_example = model.tensorize_example(example, is_training=False)
-          if tensorized_example is None:
-            example[cluster_key] = []
-          else:
-            feed_dict = {i:t for i,t in zip(model.input_tensors, tensorized_example)}
-            _, _, _, top_span_starts, top_span_ends, top_antecedents, top_antecedent_scores = session.run(model.predictions, feed_dict=feed_dict)
-            predicted_antecedents = model.get_predicted_antecedents(top_antecedents, top_antecedent_scores)
-            example[cluster_key], _ = model.get_predicted_clusters(top_span_starts, top_span_ends, predicted_antecedents)
-
-          if cluster_key == "predicted_clusters" and "clusters" in example:
-             del example["clusters"]
-
-          output_file.write(json.dumps(example))
-          output_file.write("\n")
-          if example_num % 100 == 0:
-            print("Decoded {} examples.".format(example_num + 1))
+      lines = util.JsonlinesReader(input_filename).iter_lines()
+      output_lines = predict_lines(model, session, lines, cluster_key, batch_size,
+                                   config["tensorize_threads"], config["prefetch_documents"])
+      for example_num, output_line in enumerate(output_lines):
+        output_file.write(output_line)
+        output_file.write("\n")
+        if example_num % 100 == 0:
+          print("Decoded {} examples.".format(example_num + 1))
 
   print(f"Predicted {example_num+1} examples.")
 
 
-def run_1model(config, input_filename, output_filename, cluster_key):
+# Model and session of a `run_parallel` worker process.
+_worker = {}
+
+
+def _init_worker(config, cluster_key, in_process, batch_size, num_threads):
+  session_config = tf.ConfigProto(intra_op_parallelism_threads=num_threads,
+                                  inter_op_parallelism_threads=num_threads)
+  lm_extractor = make_lm_extractor(config, session_config=session_config) if in_process else None
+  model = cm.CorefModel(config, lm_extractor=lm_extractor)
+  session = tf.Session(config=session_config)
+  model.restore(session)
+  _worker.update(model=model, session=session, config=config, cluster_key=cluster_key, batch_size=batch_size)
+
+
+def _predict_lines(lines):
+  return list(predict_lines(_worker["model"], _worker["session"], lines, _worker["cluster_key"], _worker["batch_size"],
+                            _worker["config"]["tensorize_threads"], _worker["config"]["prefetch_documents"]))
+
+
+def run_parallel(config, input_filename, output_filename, cluster_key, num_workers, in_process=False, batch_size=1):
+  """
+  Like `run`, with `num_workers` processes, each with its own model and
+  session, and an equal share of the cores.  The input is split into chunks of
+  documents, given to the workers as they become free; the output keeps the
+  order of the input.
+  """
+  num_threads = max(1, multiprocessing.cpu_count() // num_workers)
+  chunk_size = batch_size * max(1, 16 // batch_size)
+
+  chunks = util.iter_batches(util.JsonlinesReader(input_filename).iter_lines(), chunk_size)
+
+  # Spawn, not fork: the workers must not inherit the TensorFlow runtime of this process.
+  context = multiprocessing.get_context("spawn")
+  initargs = (config, cluster_key, in_process, batch_size, num_threads)
+  example_num = 0
+  with context.Pool(num_workers, initializer=_init_worker, initargs=initargs) as pool:
+    with open(output_filename, "w") as output_file:
+      for outputs in pool.imap(_predict_lines, chunks):
+        for output in outputs:
+          output_file.write(output)
+          output_file.write("\n")
+        example_num += len(outputs)
+        print("Decoded {} examples.".format(example_num))
+
+  print(f"Predicted {example_num} examples.")
+
+
+def run_1model(config, input_filename, output_filename, cluster_key, batch_size=1, num_workers=1, in_process=False):
+  if num_workers > 1:
+    run_parallel(
+      config=config,
+      input_filename=input_filename,
+      output_filename=output_filename,
+      cluster_key=cluster_key,
+      num_workers=num_workers,
+      in_process=in_process,
+      batch_size=batch_size,
+    )
+    return
   run(
     config=config,
     input_filename=input_filename,
     output_filename=output_filename,
     cluster_key=cluster_key,
+    lm_extractor=make_lm_extractor(config) if in_process else None,
+    batch_size=batch_size,
   )
 
 
-def run_2models(exp1, exp2, input_filename, output_filename):
+def run_2models(exp1, exp2, input_filename, output_filename, in_process=False, batch_size=1, num_workers=1):
+
+  extra_args = " --in-process" if in_process else ""
+  extra_args += f" --batch-size {batch_size} --workers {num_workers}"
 
-  args = f"python3 predict.py {exp1} {input_filename} intermediate.jsonlines --no-predicted".split()
+  args = f"python3 predict.py {exp1} {input_filename} intermediate.jsonlines --no-predicted{extra_args}".split()
   subprocess.run(args, check=True)
 
-  args = f"python3 predict.py {exp2} intermediate.jsonlines {output_filename} --no-bertify".split()
+  args = f"python3 predict.py {exp2} intermediate.jsonlines {output_filename} --no-bertify{extra_args}".split()
   subprocess.run(args, check=True)
 
 
@@ -87,6 +234,11 @@ if __name__ == "__main__":
   two_models = "," in sys.argv[1]
   input_filename = sys.argv[2]
   output_filename = sys.argv[3]
+  in_process = "--in-process" in sys.argv
+  # Number of documents packed into each run of the model.
+  batch_size = int(sys.argv[sys.argv.index("--batch-size") + 1]) if "--batch-size" in sys.argv else 1
+  # Number of worker processes.
+  num_workers = int(sys.argv[sys.argv.index("--workers") + 1]) if "--workers" in sys.argv else 1
 
   if two_models:
     exp1, exp2 = sys.argv[1].split(",")
@@ -94,10 +246,13 @@ if __name__ == "__main__":
       exp1, exp2,
       input_filename=input_filename,
       output_filename=output_filename,
+      in_process=in_process,
+      batch_size=batch_size,
+      num_workers=num_workers,
     )
   else:
     config = util.initialize_from_env(sys.argv[1])
-    must_bertify = "--no-bertify" not in sys.argv
+    must_bertify = "--no-bertify" not in sys.argv and not in_process
     cluster_key = "clusters" if "--no-predicted" in sys.argv else "predicted_clusters"
     config['lm_path'] = "bert_features_predict.hdf5"
     if must_bertify:
@@ -107,6 +262,9 @@ if __name__ == "__main__":
       input_filename=input_filename,
       output_filename=output_filename,
       cluster_key=cluster_key,
+      batch_size=batch_size,
+      num_workers=num_workers,
+      in_process=in_process,
     )
 
 
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""
+Prediction server: loads the model (and BERT) once and predicts the clusters of
+the jsonlines documents posted to it.
+
+  POST /predict   jsonlines documents -> the same documents, with `predicted_clusters`
+  GET  /health    {"status": "ok"}
+  GET  /metrics   queue depth and per-stage latencies
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import json
+import time
+import queue
+import threading
+import collections
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import tensorflow as tf
+
+import coref_model as cm
+import predict
+import util
+
+
+STAGES = ("queue", "tensorize", "run", "decode", "total")
+
+
+class LatencyStats(object):
+  """Thread-safe latency counters, with percentiles over the last `window` measures of each stage."""
+
+  def __init__(self, stages, window=1000):
+    self._lock = threading.Lock()
+    self._counts = collections.OrderedDict((s, 0) for s in stages)
+    self._totals = {s: 0. for s in stages}
+    self._recent = {s: collections.deque(maxlen=window) for s in stages}
+
+  def observe(self, stage, seconds):
+    with self._lock:
+      self._counts[stage] += 1
+      self._totals[stage] += seconds
+      self._recent[stage].append(seconds)
+
+  def snapshot(self):
+    with self._lock:
+      stats = collections.OrderedDict()
+      for stage, count in self._counts.items():
+        recent = np.array(self._recent[stage]) * 1000
+        stats[stage] = dict(
+          count=count,
+          mean_ms=self._totals[stage] * 1000 / count if count else 0.,
+          p50_ms=float(np.percentile(recent, 50)) if count else 0.,
+          p95_ms=float(np.percentile(recent, 95)) if count else 0.,
+          max_ms=float(recent.max()) if count else 0.,
+        )
+      return stats
+
+
+class Job(object):
+
+  def __init__(self, examples):
+    self.examples = examples
+    self.enqueue_time = time.time()
+    self.results = None
+    self.error = None
+    self.done = threading.Event()
+
+
+class PredictionService(object):
+  """
+  A model, its session and its BERT encoder (if any), shared by `num_workers`
+  threads that predict the jobs of a queue of at most `queue_size` requests.
+  """
+
+  def __init__(self, model, session, lm_extractor=None, num_workers=1, queue_size=16):
+    self.model = model
+    self.session = session
+    self.lm_extractor = lm_extractor
+    self.queue = queue.Queue(maxsize=queue_size)
+    self.stats = LatencyStats(STAGES)
+    self.num_requests = 0
+    self.num_documents = 0
+    self._counter_lock = threading.Lock()
+    self.workers = [threading.Thread(target=self._work, daemon=True) for _ in range(num_workers)]
+    for worker in self.workers:
+      worker.start()
+
+  def submit(self, examples):
+    """Queues the examples and returns their job. Raises `queue.Full` if the queue is full."""
+    job = Job(examples)
+    self.queue.put(job, block=False)
+    with self._counter_lock:
+      self.num_requests += 1
+      self.num_documents += len(examples)
+    return job
+
+  def _work(self):
+    while True:
+      job = self.queue.get()
+      if job is None:
+        break
+      self.stats.observe("queue", time.time() - job.enqueue_time)
+      try:
+        job.results = [self._predict(example) for example in job.examples]
+      except Exception as e:
+        job.error = e
+      finally:
+        job.done.set()
+
+  def _predict(self, example):
+    start_time = time.time()
+    tensorized_example = self.model.tensorize_example(example, is_training=False)
+    tensorized_time = time.time()
+    self.stats.observe("tensorize", tensorized_time - start_time)
+    if tensorized_example is None:
+      example["predicted_clusters"] = []
+    else:
+      feed_dict = {i:t for i,t in zip(self.model.input_tensors, tensorized_example)}
+      _, _, _, top_span_starts, top_span_ends, top_antecedents, top_antecedent_scores = self.session.run(self.model.predictions, feed_dict=feed_dict)
+      run_time = time.time()
+      self.stats.observe("run", run_time - tensorized_time)
+      predicted_antecedents = self.model.get_predicted_antecedents(top_antecedents, top_antecedent_scores)
+      example["predicted_clusters"], _ = self.model.get_predicted_clusters(top_span_starts, top_span_ends, predicted_antecedents)
+      self.stats.observe("decode", time.time() - run_time)
+    example.pop("clusters", None)
+    self.stats.observe("total", time.time() - start_time)
+    return example
+
+  def metrics(self):
+    return collections.OrderedDict([
+      ("queue_depth", self.queue.qsize()),
+      ("queue_size", self.queue.maxsize),
+      ("workers", len(self.workers)),
+      ("requests", self.num_requests),
+      ("documents", self.num_documents),
+      ("latency", self.stats.snapshot()),
+    ])
+
+  def close(self):
+    for _ in self.workers:
+      self.queue.put(None)
+    for worker in self.workers:
+      worker.join()
+    self.session.close()
+    if self.lm_extractor is not None:
+      self.lm_extractor.close()
+
+
+def make_service(config, num_workers=1, queue_size=16):
+  lm_extractor = predict.make_lm_extractor(config)
+  model = cm.CorefModel(config, lm_extractor=lm_extractor)
+  session = tf.Session()
+  model.restore(session)
+  return PredictionService(model, session, lm_extractor, num_workers=num_workers, queue_size=queue_size)
+
+
+def make_handler(service):
+
+  class PredictionHandler(BaseHTTPRequestHandler):
+
+    def _send(self, status, body, content_type="application/json"):
+      body = body.encode("utf-8")
+      self.send_response(status)
+      self.send_header("Content-Type", content_type)
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def _send_json(self, status, value):
+      self._send(status, json.dumps(value))
+
+    def do_GET(self):
+      if self.path == "/health":
+        self._send_json(200, {"status": "ok"})
+      elif self.path == "/metrics":
+        self._send_json(200, service.metrics())
+      else:
+        self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+      if self.path != "/predict":
+        self._send_json(404, {"error": "not found"})
+        return
+      length = int(self.headers.get("Content-Length", 0))
+      try:
+        examples = [util.loads_json(line) for line in self.rfile.read(length).decode("utf-8").splitlines() if line.strip()]
+      except ValueError as e:
+        self._send_json(400, {"error": "invalid jsonlines: {}".format(e)})
+        return
+      try:
+        job = service.submit(examples)
+      except queue.Full:
+        self._send_json(503, {"error": "queue is full"})
+        return
+      job.done.wait()
+      if job.error is not None:
+        self._send_json(500, {"error": "{}: {}".format(type(job.error).__name__, job.error)})
+        return
+      self._send(200, "".join(json.dumps(e) + "\n" for e in job.results), content_type="application/x-ndjson")
+
+  return PredictionHandler
+
+
+if __name__ == "__main__":
+  parser = ArgumentParser()
+  parser.add_argument('experiment')
+  parser.add_argument('--host', default="127.0.0.1")
+  parser.add_argument('--port', type=int, default=8080)
+  parser.add_argument('--workers', type=int, default=1)
+  parser.add_argument('--queue-size', type=int, default=16)
+  args = parser.parse_args()
+
+  config = util.initialize_from_env(args.experiment)
+  service = make_service(config, num_workers=args.workers, queue_size=args.queue_size)
+  server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+  print("Listening on http://{}:{}".format(args.host, args.port))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    service.close()
+    sys.exit(0)
@@ -4,15 +4,19 @@
 curl -O https://dl.fbaipublicfiles.com/fasttext/vectors-crawl/cc.fr.300.vec.gz
 gunzip -d cc.fr.300.vec.gz
 
+# Convert them to the binary (memory-mapped) format.
+python3 convert_embeddings.py cc.fr.300.vec
+
 # Build custom kernels.
 TF_CFLAGS=( $(python3 -c 'import tensorflow as tf; print(" ".join(tf.sysconfig.get_compile_flags()))') )
 TF_LFLAGS=( $(python3 -c 'import tensorflow as tf; print(" ".join(tf.sysconfig.get_link_flags()))') )
 
 # Linux (pip)
 g++ -std=c++11 -shared coref_kernels.cc -o coref_kernels.so -fPIC ${TF_CFLAGS[@]} ${TF_LFLAGS[@]} -O2 -D_GLIBCXX_USE_CXX11_ABI=0
-g++ -std=c++11 -shared coref_kernels_gold_mentions.cc -o coref_kernels_gold_mentions.so -fPIC ${TF_CFLAGS[@]} ${TF_LFLAGS[@]} -O2 -D_GLIBCXX_USE_CXX11_ABI=0
 #g++ -shared coref_kernels.cc -o coref_kernels.so -fPIC ${TF_CFLAGS[@]} ${TF_LFLAGS[@]} -O2
-#g++ -shared coref_kernels_gold_mentions.cc -o coref_kernels_gold_mentions.so -fPIC ${TF_CFLAGS[@]} ${TF_LFLAGS[@]} -O2
+
+# Benchmark of the span selection of the kernel (no TensorFlow needed).
+#g++ -std=c++11 -O2 extract_spans_benchmark.cc -o extract_spans_benchmark && ./extract_spans_benchmark
 
 # Linux (build from source)
 #g++ -std=c++11 -shared coref_kernels.cc -o coref_kernels.so -fPIC ${TF_CFLAGS[@]} ${TF_LFLAGS[@]} -O2
@@ -0,0 +1,151 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import io
+import os
+import shutil
+import tempfile
+
+import h5py
+import numpy as np
+import pyhocon
+import tensorflow as tf
+
+import util
+import coref_model as cm
+
+
+class BatchedCharFeaturesTest(tf.test.TestCase):
+  """The char CNN features of a document don't depend on the documents batched with it."""
+
+  def setUp(self):
+    tf.reset_default_graph()
+    self.model = cm.CorefModel.__new__(cm.CorefModel)
+    self.model.config = {"filter_widths": [3, 4, 5]}
+    self.model.char_dict = util.CharDictionary([u"<unk>"] + list(u"abcdefghijklmnopqrstuvwxyz"))
+    self.char_emb = tf.constant(np.random.RandomState(0).randn(len(self.model.char_dict), 8), dtype=tf.float32)
+
+  def tensorize(self, sentences):
+    max_sentence_length = max(len(s) for s in sentences)
+    max_word_length = max(max(max(len(w) for w in s) for s in sentences), max(self.model.config["filter_widths"]))
+    tokens = np.array([s + [""] * (max_sentence_length - len(s)) for s in sentences])
+    char_index = self.model.char_dict.index_sentences(sentences, max_sentence_length, max_word_length)
+    text_len = np.array([len(s) for s in sentences], dtype=np.int32)
+    return tokens, char_index, text_len
+
+  def char_features(self, tokens, char_index, text_len, doc_ids, num_docs):
+    num_sentences, max_sentence_length, max_word_length = char_index.shape
+    sentence_max_word_lengths = self.model.get_sentence_max_word_lengths(
+      tf.constant(tokens), tf.constant(text_len), tf.constant(doc_ids), num_docs, max_word_length)
+    lengths = tf.reshape(tf.tile(tf.expand_dims(sentence_max_word_lengths, 1), [1, max_sentence_length]), [-1])
+    char_emb = tf.reshape(tf.gather(self.char_emb, char_index), [num_sentences * max_sentence_length, max_word_length, 8])
+    with tf.variable_scope("cnn", reuse=tf.AUTO_REUSE):
+      features = util.cnn(char_emb, self.model.config["filter_widths"], 4, lengths)
+    return tf.reshape(features, [num_sentences, max_sentence_length, -1])
+
+  def test_batched_features_match_single_documents(self):
+    documents = [[[u"ab", u"cde"], [u"fgh"]], [[u"abcdefghijklmno", u"z"]]]
+    singles = []
+    for sentences in documents:
+      tokens, char_index, text_len = self.tensorize(sentences)
+      singles.append((self.char_features(tokens, char_index, text_len, np.zeros(text_len.sum(), np.int32), 1),
+                      text_len))
+
+    tensorized = [self.tensorize(sentences) for sentences in documents]
+    max_sentence_length = max(t.shape[1] for t, _, _ in tensorized)
+    max_word_length = max(c.shape[2] for _, c, _ in tensorized)
+    tokens = np.concatenate([np.pad(t, [(0, 0), (0, max_sentence_length - t.shape[1])], mode="constant",
+                                    constant_values="") for t, _, _ in tensorized])
+    char_index = np.concatenate([np.pad(c, [(0, 0), (0, max_sentence_length - c.shape[1]),
+                                            (0, max_word_length - c.shape[2])], mode="constant")
+                                 for _, c, _ in tensorized])
+    text_len = np.concatenate([l for _, _, l in tensorized])
+    doc_ids = np.repeat(np.arange(len(documents), dtype=np.int32), [l.sum() for _, _, l in tensorized])
+    batched = self.char_features(tokens, char_index, text_len, doc_ids, len(documents))
+
+    with self.test_session() as session:
+      session.run(tf.global_variables_initializer())
+      batched = session.run(batched)
+      sentence_offset = 0
+      for single, single_text_len in singles:
+        single = session.run(single)
+        for i, length in enumerate(single_text_len):
+          self.assertAllClose(single[i, :length], batched[sentence_offset + i, :length])
+        sentence_offset += len(single_text_len)
+
+
+class BatchedPredictionsTest(tf.test.TestCase):
+  """Batched documents get the same top spans, antecedents and clusters as one at a time."""
+
+  documents = [
+    {"doc_key": "ge/a", "sentences": [[u"Marie", u"dit", u"qu'", u"elle", u"viendra", u"."],
+                                     [u"Elle", u"arrive", u"demain", u"avec", u"son", u"frère", u"."]],
+     "speakers": [[u"-"] * 6, [u"-"] * 7], "clusters": [[[0, 0], [3, 3], [6, 6]]]},
+    {"doc_key": "ge/b", "sentences": [[u"Le", u"chat", u"dort", u"."],
+                                     [u"Il", u"rêve", u"d'", u"une", u"souris", u"extraordinairement", u"grande", u"."],
+                                     [u"Elle", u"court", u"."]],
+     "speakers": [[u"A"] * 4, [u"B"] * 8, [u"A"] * 3], "clusters": [[[0, 1], [4, 4]], [[7, 10], [12, 12]]]},
+    {"doc_key": "ge/c", "sentences": [[u"Paul", u"est", u"là", u"."]],
+     "speakers": [[u"-"] * 4], "clusters": []},
+  ]
+
+  def setUp(self):
+    tf.reset_default_graph()
+    self.temp_dir = tempfile.mkdtemp()
+    random_state = np.random.RandomState(0)
+    words = sorted(set(w for d in self.documents for s in d["sentences"] for w in s))
+    embeddings_path = os.path.join(self.temp_dir, "embeddings.vec")
+    with io.open(embeddings_path, "w", encoding="utf-8") as f:
+      for word in words:
+        f.write(u"{} {}\n".format(word, " ".join(str(x) for x in random_state.randn(10))))
+    char_vocab_path = os.path.join(self.temp_dir, "char_vocab.txt")
+    with io.open(char_vocab_path, "w", encoding="utf-8") as f:
+      f.write(u"\n".join(sorted(set(c for w in words for c in w))))
+    config = pyhocon.ConfigFactory.parse_file(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                           "experiments.conf"))["fr_base"]
+    config["context_embeddings"] = config["head_embeddings"] = {"path": embeddings_path, "size": 10}
+    config["char_vocab_path"] = char_vocab_path
+    config["lm_path"] = os.path.join(self.temp_dir, "features.hdf5")
+    config["lm_size"] = 8
+    config["log_dir"] = self.temp_dir
+    with h5py.File(config["lm_path"], "w") as f:
+      for document in self.documents:
+        num_words = sum(len(s) for s in document["sentences"])
+        file_key = document["doc_key"].replace("/", ":")
+        f.create_dataset(file_key + "/embeddings", data=random_state.randn(num_words, 8, config["lm_layers"]))
+        f.create_dataset(file_key + "/sentence_offsets",
+                         data=np.cumsum([0] + [len(s) for s in document["sentences"]]))
+    self.model = cm.CorefModel(config, eval_mode=True)
+
+  def tearDown(self):
+    self.model.lm_file.close()
+    shutil.rmtree(self.temp_dir)
+
+  def predict(self, session, tensors):
+    feed_dict = {i: t for i, t in zip(self.model.input_tensors, tensors)}
+    return session.run(self.model.predictions, feed_dict=feed_dict)[3:]
+
+  def test_batched_predictions_match_single_documents(self):
+    tensorized = [self.model.tensorize_example(d, is_training=False) for d in self.documents]
+    with self.test_session() as session:
+      session.run(tf.global_variables_initializer())
+      singles = [self.predict(session, t) for t in tensorized]
+      tensors, word_offsets = self.model.tensorize_batch(tensorized)
+      batched = list(self.model.split_batch_predictions(*self.predict(session, tensors), word_offsets))
+
+    self.assertEqual(len(batched), len(singles))
+    for single, batch in zip(singles, batched):
+      top_span_starts, top_span_ends, top_antecedents, top_antecedent_scores = single
+      self.assertAllEqual(top_span_starts, batch[0])
+      self.assertAllEqual(top_span_ends, batch[1])
+      # The batch has more antecedent columns (-inf for the spans of the other documents).
+      self.assertAllClose(top_antecedent_scores.max(1), batch[3].max(1), atol=1e-5)
+      predicted_antecedents = self.model.get_predicted_antecedents(top_antecedents, top_antecedent_scores)
+      self.assertAllEqual(predicted_antecedents, self.model.get_predicted_antecedents(batch[2], batch[3]))
+      self.assertEqual(self.model.get_predicted_clusters(top_span_starts, top_span_ends, predicted_antecedents)[0],
+                       self.model.get_predicted_clusters(batch[0], batch[1], predicted_antecedents)[0])
+
+
+if __name__ == "__main__":
+  tf.test.main()
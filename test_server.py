@@ -0,0 +1,131 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import threading
+import time
+import unittest
+from http.server import ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import server
+
+
+class StubModel(object):
+  """Predicts the first two words of each document as one cluster."""
+
+  input_tensors = ["sentences"]
+  predictions = "predictions"
+
+  def tensorize_example(self, example, is_training):
+    return (example["sentences"],)
+
+  def get_predicted_antecedents(self, top_antecedents, top_antecedent_scores):
+    return [-1, 0]
+
+  def get_predicted_clusters(self, top_span_starts, top_span_ends, predicted_antecedents):
+    return [((0, 0), (1, 1))], {}
+
+
+class StubSession(object):
+  """Runs the stub graph, blocking while `release` is not set."""
+
+  def __init__(self):
+    self.running = threading.Event()
+    self.release = threading.Event()
+    self.release.set()
+
+  def run(self, fetches, feed_dict):
+    self.running.set()
+    self.release.wait()
+    return None, None, None, [0, 1], [0, 1], [[0], [0]], [[0., 1.], [0., 1.]]
+
+  def close(self):
+    pass
+
+
+class PredictionServerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.session = StubSession()
+    self.service = server.PredictionService(StubModel(), self.session, num_workers=1, queue_size=1)
+    self.server = ThreadingHTTPServer(("127.0.0.1", 0), server.make_handler(self.service))
+    self.url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+    self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+    self.server_thread.start()
+
+  def tearDown(self):
+    self.session.release.set()
+    self.server.shutdown()
+    self.server.server_close()
+    self.service.close()
+
+  def get(self, path):
+    with urlopen(self.url + path) as response:
+      return response.status, json.loads(response.read().decode("utf-8"))
+
+  def post(self, documents):
+    return self.post_body("".join(json.dumps(d) + "\n" for d in documents).encode("utf-8"))
+
+  def post_body(self, body):
+    try:
+      with urlopen(Request(self.url + "/predict", data=body)) as response:
+        return response.status, response.read().decode("utf-8")
+    except HTTPError as e:
+      return e.code, e.read().decode("utf-8")
+
+  def make_document(self, doc_key):
+    return {"doc_key": doc_key, "sentences": [["Marie", "elle", "dort"]], "speakers": [["-", "-", "-"]],
+            "clusters": []}
+
+  def test_health(self):
+    self.assertEqual(self.get("/health"), (200, {"status": "ok"}))
+
+  def test_predict(self):
+    status, body = self.post([self.make_document("a"), self.make_document("b")])
+    self.assertEqual(status, 200)
+    documents = [json.loads(line) for line in body.splitlines()]
+    self.assertEqual([d["doc_key"] for d in documents], ["a", "b"])
+    for document in documents:
+      self.assertEqual(document["predicted_clusters"], [[[0, 0], [1, 1]]])
+      self.assertNotIn("clusters", document)
+
+  def test_invalid_jsonlines(self):
+    status, _ = self.post_body(b"{not json\n")
+    self.assertEqual(status, 400)
+
+  def test_metrics(self):
+    self.post([self.make_document("a")])
+    status, metrics = self.get("/metrics")
+    self.assertEqual(status, 200)
+    self.assertEqual(metrics["requests"], 1)
+    self.assertEqual(metrics["documents"], 1)
+    self.assertEqual(metrics["queue_size"], 1)
+    self.assertEqual(sorted(metrics["latency"]), sorted(server.STAGES))
+    self.assertEqual(metrics["latency"]["run"]["count"], 1)
+
+  def test_full_queue(self):
+    self.session.release.clear()
+    responses = []
+    requests = [threading.Thread(target=lambda: responses.append(self.post([self.make_document("a")])))]
+    requests[0].start()
+    # The worker is now blocked on the first request, the second one fills the queue.
+    self.assertTrue(self.session.running.wait(5))
+    requests.append(threading.Thread(target=lambda: responses.append(self.post([self.make_document("b")]))))
+    requests[1].start()
+    while self.service.queue.qsize() < 1:
+      time.sleep(0.01)
+    status, body = self.post([self.make_document("c")])
+    self.assertEqual(status, 503)
+    self.assertEqual(json.loads(body), {"error": "queue is full"})
+
+    self.session.release.set()
+    for request in requests:
+      request.join()
+    self.assertEqual([status for status, _ in responses], [200, 200])
+
+
+if __name__ == "__main__":
+  unittest.main()
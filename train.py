@@ -20,7 +20,7 @@ if __name__ == "__main__":
   report_frequency = config["report_frequency"]
   eval_frequency = config["eval_frequency"]
 
-  model = cm.CorefModel(config)
+  model = cm.CorefModel(config, use_tensorize_cache=True)
 
   print('# parameters:', np.sum([np.prod(v.get_shape().as_list()) for v in model.trainable_variables]))
   saver = tf.train.Saver()
@@ -33,7 +33,6 @@ if __name__ == "__main__":
 
   with tf.Session() as session:
     session.run(tf.global_variables_initializer())
-    model.start_enqueue_thread(session)
     accumulated_loss = 0.0
 
     ckpt = tf.train.get_checkpoint_state(log_dir)
@@ -41,6 +40,7 @@ if __name__ == "__main__":
       print("Restoring from: {}".format(ckpt.model_checkpoint_path))
       saver.restore(session, ckpt.model_checkpoint_path)
       initial_step = session.run(model.global_step)
+    model.start_input_pipeline(session)
 
     initial_time = time.time()
     while True:
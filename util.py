@@ -3,11 +3,17 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import io
 import errno
+import hashlib
+import itertools
 import codecs
 import collections
+import json
 import math
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import six
@@ -17,6 +23,11 @@ from argparse import ArgumentParser
 from colorama import Back, Style
 from pip._vendor.colorama import Fore
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 def get_cluster_config():
     # # Distributed training configurations.
@@ -79,6 +90,205 @@ def flatten(l):
     return [item for sublist in l for item in sublist]
 
 
+def pad_by_sentence(flattened, sentence_offsets):
+    # [num_words, ...] -> zero-padded [num_sentences, max_sentence_length, ...].
+    text_len = np.diff(sentence_offsets)
+    padded = np.zeros([len(text_len), text_len.max()] + list(flattened.shape[1:]), dtype=flattened.dtype)
+    sentence_indices = np.repeat(np.arange(len(text_len)), text_len)
+    word_indices = np.arange(len(flattened)) - np.repeat(sentence_offsets[:-1], text_len)
+    padded[sentence_indices, word_indices] = flattened
+    return padded
+
+
+LM_PRECISIONS = ("float32", "float16", "int8")
+
+
+def quantize_lm_emb(embeddings, precision):
+    # Returns the LM embeddings in the storage precision, and their per-vector scales for int8 (else None).
+    if precision == "float32":
+        return embeddings, None
+    if precision == "float16":
+        return embeddings.astype(np.float16), None
+    if precision == "int8":
+        scales = (np.abs(embeddings).max(axis=1) / 127.).astype(np.float32)  # [num_tokens, num_layers]
+        divisors = np.where(scales > 0, scales, 1)
+        return np.round(embeddings / np.expand_dims(divisors, 1)).astype(np.int8), scales
+    raise ValueError("Unknown LM precision: {} (expected one of {})".format(precision, ", ".join(LM_PRECISIONS)))
+
+
+def dequantize_lm_emb(embeddings, scales=None):
+    # Inverse of quantize_lm_emb(), to float32.
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if scales is not None:
+        embeddings = embeddings * np.expand_dims(scales, 1)
+    return embeddings
+
+
+def get_lm_mix_path(log_dir):
+    return os.path.join(log_dir, "lm_mix.json")
+
+
+def load_lm_mix(path):
+    # Layer weights and scaling written by export_lm_mix.py.
+    with open(path) as f:
+        lm_mix = json.load(f)
+    return np.array(lm_mix["weights"], dtype=np.float32), np.float32(lm_mix["scaling"])
+
+
+def mix_lm_layers(embeddings, weights, scaling):
+    # Mixes [..., num_layers] LM embeddings into [..., 1], as the model does.
+    return np.expand_dims(np.dot(embeddings, weights) * scaling, -1).astype(np.float32)
+
+
+def prefetch_map(fn, iterable, num_threads=1, depth=1):
+    # Lazy, ordered map(fn, iterable), computing up to depth items ahead in background threads.
+    if num_threads <= 0:
+        for x in iterable:
+            yield fn(x)
+        return
+    with ThreadPoolExecutor(num_threads) as executor:
+        futures = collections.deque()
+        for x in iterable:
+            futures.append(executor.submit(fn, x))
+            if len(futures) > depth:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+def loads_json(line):
+    # json.loads, with orjson if installed.
+    if orjson is not None:
+        return orjson.loads(line)
+    return json.loads(line)
+
+
+def iter_batches(iterable, batch_size):
+    # Items of iterable in lists of batch_size (the last one may be shorter).
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+class JsonlinesReader(object):
+    # Reads the documents of a jsonlines file one line at a time.
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+
+    def iter_lines(self):
+        # Non-empty lines of the file, as bytes.
+        for _, line in self._iter_lines_with_offsets():
+            yield line
+
+    def _iter_lines_with_offsets(self):
+        offset = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    yield offset, line
+                offset += len(line)
+
+    def __iter__(self):
+        for line in self.iter_lines():
+            yield loads_json(line)
+
+    def read_at(self, offset, length=None):
+        # Thread-safe.
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "rb")
+            self._file.seek(offset)
+            line = self._file.readline() if length is None else self._file.read(length)
+        return loads_json(line)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def bucket_indices(indices, keys, window_size, bucket_size, random_state):
+    # Sorts each window of indices by key, then shuffles its buckets.
+    indices = np.asarray(indices)
+    keys = np.asarray(keys)
+    if keys.ndim == 1:
+        keys = keys[:, None]
+    bucketed = []
+    for start in range(0, len(indices), window_size):
+        window = indices[start:start + window_size]
+        # lexsort sorts by its last key first.
+        window = window[np.lexsort(keys[window].T[::-1])]
+        buckets = [window[i:i + bucket_size] for i in range(0, len(window), bucket_size)]
+        for b in random_state.permutation(len(buckets)):
+            bucketed.append(buckets[b])
+    return np.concatenate(bucketed) if bucketed else indices
+
+
+class JsonlinesIndex(object):
+    # Doc key, offset, length and size of each document of a jsonlines file, cached in <path>.index.
+
+    COLUMNS = ("doc_key", "offset", "length", "num_sentences", "max_sentence_length")
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + ".index"
+        self.reader = JsonlinesReader(path)
+        if not self._load():
+            self._build()
+            if not self._load():
+                raise ValueError("Could not read the index {}".format(self.index_path))
+
+    def _get_source_stat(self):
+        stat = os.stat(self.path)
+        return dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, columns=list(self.COLUMNS))
+
+    def _build(self):
+        print("Indexing {}...".format(self.path))
+        header = self._get_source_stat()
+        temp_path = "{}.{}.tmp".format(self.index_path, os.getpid())
+        with io.open(temp_path, "w", encoding="utf-8", newline="\n") as f:
+            f.write(json.dumps(header) + u"\n")
+            for offset, line in self.reader._iter_lines_with_offsets():
+                example = loads_json(line)
+                sentences = example["sentences"]
+                max_sentence_length = max(len(s) for s in sentences) if sentences else 0
+                f.write(u"{}\t{}\t{}\t{}\t{}\n".format(example["doc_key"], offset, len(line), len(sentences),
+                                                       max_sentence_length))
+        os.replace(temp_path, self.index_path)
+
+    def _load(self):
+        # Returns whether the index file was up to date.
+        if not os.path.exists(self.index_path):
+            return False
+        with io.open(self.index_path, encoding="utf-8") as f:
+            if json.loads(f.readline()) != self._get_source_stat():
+                return False
+            rows = [line.rstrip(u"\n").split(u"\t") for line in f]
+        self.doc_keys = [row[0] for row in rows]
+        self.offsets = np.array([int(row[1]) for row in rows], dtype=np.int64)
+        self.lengths = np.array([int(row[2]) for row in rows], dtype=np.int64)
+        self.num_sentences = np.array([int(row[3]) for row in rows], dtype=np.int32)
+        self.max_sentence_lengths = np.array([int(row[4]) for row in rows], dtype=np.int32)
+        return True
+
+    def __len__(self):
+        return len(self.doc_keys)
+
+    def read(self, i):
+        # Thread-safe.
+        return self.reader.read_at(self.offsets[i], self.lengths[i])
+
+    def close(self):
+        self.reader.close()
+
+
 def set_gpus(*gpus):
     os.environ["CUDA_VISIBLE_DEVICES"] = ",".join(str(g) for g in gpus)
     print("Setting CUDA_VISIBLE_DEVICES to: {}".format(os.environ["CUDA_VISIBLE_DEVICES"]))
@@ -93,13 +303,45 @@ def mkdirs(path):
     return path
 
 
+class CharDictionary(collections.defaultdict):
+    # Character -> id (0: unknown), memoizing the char ids of each word.
+
+    def __init__(self, vocab):
+        super(CharDictionary, self).__init__(int, ((c, i) for i, c in enumerate(vocab)))
+        self._word_ids = {}
+
+    def word_ids(self, word):
+        # Not to be modified.
+        ids = self._word_ids.get(word)
+        if ids is None:
+            # `get`, not `[]`: unknown characters must not be added to the dictionary.
+            ids = np.array([self.get(c, 0) for c in word], dtype=np.int32)
+            self._word_ids[word] = ids
+        return ids
+
+    def index_sentences(self, sentences, max_sentence_length, max_word_length):
+        # [num_sentences, max_sentence_length, max_word_length] char ids, padded with 0.
+        char_index = np.zeros([len(sentences), max_sentence_length, max_word_length], dtype=np.int32)
+        words = [word for sentence in sentences for word in sentence]
+        if not words:
+            return char_index
+        word_lengths = np.array([len(word) for word in words])
+        sentence_lengths = [len(sentence) for sentence in sentences]
+        sentence_ids = np.repeat(np.arange(len(sentences)), sentence_lengths)
+        word_positions = np.arange(len(words)) - np.repeat(np.cumsum(sentence_lengths) - sentence_lengths,
+                                                           sentence_lengths)
+        char_positions = np.arange(word_lengths.sum()) - np.repeat(np.cumsum(word_lengths) - word_lengths,
+                                                                   word_lengths)
+        char_index[np.repeat(sentence_ids, word_lengths), np.repeat(word_positions, word_lengths),
+                   char_positions] = np.concatenate([self.word_ids(word) for word in words])
+        return char_index
+
+
 def load_char_dict(char_vocab_path):
     vocab = [u"<unk>"]
     with codecs.open(char_vocab_path, encoding="utf-8") as f:
         vocab.extend(l.strip() for l in f.readlines())
-    char_dict = collections.defaultdict(int)
-    char_dict.update({c: i for i, c in enumerate(vocab)})
-    return char_dict
+    return CharDictionary(vocab)
 
 
 def maybe_divide(x, y):
@@ -160,7 +402,8 @@ def ffnn(inputs, num_hidden_layers, hidden_size, output_size, dropout, output_we
     return outputs
 
 
-def cnn(inputs, filter_sizes, num_filters):
+def cnn(inputs, filter_sizes, num_filters, lengths=None):
+    # With `lengths` ([num_words], at least max(filter_sizes)), only the windows in the first lengths[i] positions are pooled.
     num_words = shape(inputs, 0)
     num_chars = shape(inputs, 1)
     input_size = shape(inputs, 2)
@@ -171,6 +414,10 @@ def cnn(inputs, filter_sizes, num_filters):
             b = tf.get_variable("b", [num_filters])
         conv = tf.nn.conv1d(inputs, w, stride=1, padding="VALID")  # [num_words, num_chars - filter_size, num_filters]
         h = tf.nn.relu(tf.nn.bias_add(conv, b))  # [num_words, num_chars - filter_size, num_filters]
+        if lengths is not None:
+            # ReLU outputs are >= 0 and each word has a valid window: zeroing the others doesn't change the max.
+            window_mask = tf.sequence_mask(lengths - filter_size + 1, shape(h, 1), dtype=tf.float32)
+            h *= tf.expand_dims(window_mask, 2)  # [num_words, num_chars - filter_size, num_filters]
         pooled = tf.reduce_max(h, 1)  # [num_words, num_filters]
         outputs.append(pooled)
     return tf.concat(outputs, 1)  # [num_words, num_filters * len(filter_sizes)]
@@ -658,53 +905,166 @@ class RetrievalEvaluator(object):
         return recall, precision, f1
 
 
+def get_binary_embedding_paths(path):
+    # Vocabulary and matrix paths of the binary version of an embedding file.
+    return path + ".vocab", path + ".npy"
+
+
 class EmbeddingDictionary(object):
     def __init__(self, info, normalize=True, maybe_cache=None):
         self._size = info["size"]
         self._normalize = normalize
         self._path = info["path"]
-        if maybe_cache is not None and maybe_cache._path == self._path:
+        self._cache = None
+        if maybe_cache is not None and maybe_cache._path == self._path and maybe_cache._normalize == normalize:
             assert self._size == maybe_cache._size
-            self._embeddings = maybe_cache._embeddings
-        else:
-            self._embeddings = self.load_embedding_dict(self._path)
+            self._cache = maybe_cache
+        # Loaded lazily, on the first lookup (possibly from several threads).
+        self._word_to_index = None
+        self._embeddings = None
+        self._lock = threading.Lock()
 
     @property
     def size(self):
         return self._size
 
+    def shares_table_with(self, other):
+        return self._path == other._path and self._normalize == other._normalize and self._size == other._size
+
+    def _load(self):
+        if self._embeddings is None:
+            with self._lock:
+                if self._embeddings is None:
+                    if self._cache is not None:
+                        word_to_index, embeddings = self._cache._load()
+                    else:
+                        word_to_index, embeddings = self.load_embedding_dict(self._path)
+                    self._word_to_index = word_to_index
+                    self._embeddings = embeddings
+        return self._word_to_index, self._embeddings
+
     def load_embedding_dict(self, path):
+        # Row 0 is the (zero) embedding of unknown words.
+        vocab_path, matrix_path = get_binary_embedding_paths(path)
+        if len(path) > 0 and os.path.exists(vocab_path) and os.path.exists(matrix_path):
+            return self.load_binary_embeddings(vocab_path, matrix_path)
         print("Loading word embeddings from {}...".format(path))
-        default_embedding = np.zeros(self.size)
-        embedding_dict = collections.defaultdict(lambda: default_embedding)
+        word_to_index = {}
+        embeddings = [np.zeros(self.size, dtype=np.float32)]
         if len(path) > 0:
-            vocab_size = None
             with open(path) as f:
-                for i, line in enumerate(f.readlines()):
+                for i, line in enumerate(f):
                     word_end = line.find(" ")
                     word = line[:word_end]
                     embedding = np.fromstring(line[word_end + 1:], np.float32, sep=" ")
                     if i == 0 and len(embedding) == 1:
                       continue
                     assert len(embedding) == self.size, "%d,%d: %d: %s" % (len(embedding), self.size, i, line)
-                    embedding_dict[word] = embedding
-            if vocab_size is not None:
-                assert vocab_size == len(embedding_dict)
+                    word_to_index[word] = len(embeddings)
+                    embeddings.append(embedding)
             print("Done loading word embeddings.")
-        return embedding_dict
+        embeddings = np.stack(embeddings)
+        if self._normalize:
+            embeddings = self.normalize(embeddings)
+        return word_to_index, embeddings
+
+    def load_binary_embeddings(self, vocab_path, matrix_path):
+        # Loads the output of convert_embeddings.py, memory-mapped.
+        print("Loading binary word embeddings from {}...".format(matrix_path))
+        embeddings = np.load(matrix_path, mmap_mode="r")
+        with io.open(vocab_path, encoding="utf-8", newline="\n") as f:
+            header = [int(x) for x in f.readline().split()]
+            word_to_index = {line[:-1]: i + 1 for i, line in enumerate(f)}
+        num_words, size = header[:2]
+        normalized = len(header) > 2 and header[2] == 1
+        assert size == self.size, "%d,%d: %s" % (size, self.size, vocab_path)
+        assert embeddings.shape == (num_words + 1, self.size), "%s: %s" % (embeddings.shape, matrix_path)
+        if self._normalize and not normalized:
+            print("{} is not normalized, normalizing in memory (rerun convert_embeddings.py to avoid this).".format(
+                matrix_path))
+            embeddings = self.normalize(np.array(embeddings))
+        elif normalized and not self._normalize:
+            raise ValueError("{} is normalized, rerun convert_embeddings.py with --raw".format(matrix_path))
+        print("Done loading word embeddings.")
+        return word_to_index, embeddings
 
     def __getitem__(self, key):
-        embedding = self._embeddings[key]
-        if self._normalize:
-            embedding = self.normalize(embedding)
-        return embedding
-
-    def normalize(self, v):
-        norm = np.linalg.norm(v)
-        if norm > 0:
-            return v / norm
-        else:
-            return v
+        word_to_index, embeddings = self._load()
+        return embeddings[word_to_index.get(key, 0)]
+
+    def lookup_sentences(self, sentences, max_sentence_length=None):
+        # Zero-padded [num_sentences, max_sentence_length, size] embeddings of a document.
+        word_to_index, embeddings = self._load()
+        if max_sentence_length is None:
+            max_sentence_length = max(len(s) for s in sentences)
+        indices = np.zeros([len(sentences), max_sentence_length], dtype=np.int64)
+        for i, sentence in enumerate(sentences):
+            indices[i, :len(sentence)] = [word_to_index.get(word, 0) for word in sentence]
+        return np.asarray(embeddings[indices])
+
+    def normalize(self, embeddings):
+        # L2-normalizes the rows in place; zero rows are left unchanged.
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        embeddings /= norms
+        return embeddings
+
+
+class TensorizationCache(object):
+    # LRU cache of tensorized documents in memory, and optionally in .npz files. Thread-safe.
+
+    def __init__(self, max_bytes=0, directory=None):
+        self._max_bytes = max_bytes
+        self._directory = directory
+        if directory:
+            mkdirs(directory)
+        self._entries = collections.OrderedDict()
+        self._num_bytes = 0
+        self._lock = threading.Lock()
+
+    def _get_path(self, key):
+        return os.path.join(self._directory, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".npz")
+
+    def get(self, key):
+        # None if key is not cached.
+        with self._lock:
+            tensors = self._entries.get(key)
+            if tensors is not None:
+                self._entries.move_to_end(key)
+                return tensors
+        if self._directory:
+            path = self._get_path(key)
+            if os.path.exists(path):
+                with np.load(path) as npz:
+                    tensors = tuple(npz["arr_{}".format(i)] for i in range(len(npz.files)))
+                self._remember(key, tensors)
+                return tensors
+        return None
+
+    def put(self, key, tensors):
+        tensors = tuple(np.asarray(t) for t in tensors)
+        if self._directory:
+            path = self._get_path(key)
+            if not os.path.exists(path):
+                # Written aside, then renamed: concurrent readers never see a partial file.
+                temp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.current_thread().ident)
+                with open(temp_path, "wb") as f:
+                    np.savez(f, *tensors)
+                os.replace(temp_path, path)
+        self._remember(key, tensors)
+
+    def _remember(self, key, tensors):
+        num_bytes = sum(t.nbytes for t in tensors)
+        if num_bytes > self._max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = tensors
+            self._num_bytes += num_bytes
+            while self._num_bytes > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._num_bytes -= sum(t.nbytes for t in evicted)
 
 
 class CustomLSTMCell(tf.contrib.rnn.RNNCell):